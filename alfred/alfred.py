@@ -1,48 +1,385 @@
 from __future__ import print_function
 
+import json
 import logging
 import os
 import shlex
-from subprocess import Popen, PIPE
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from fnmatch import fnmatch
+from Queue import Queue
+from subprocess import Popen, PIPE, STDOUT
 
-import boto3
-from pymemcache.client.hash import HashClient
-import requests
+# Everything heavy (boto3, requests, pymemcache, pynamodb, slacker) is imported
+# on first use through profiling.lazy_import, so help and error paths load none of it.
+import profiling
+import sessions
+from metrics import Metrics
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
+metrics = Metrics('alfred')
 MEMCACHED_ENDPOINT = 'alfredbot-users.atjtz9.cfg.euw1.cache.amazonaws.com'
 MEMCACHED_PORT = 11211
+MEMCACHED_CONNECT_TIMEOUT = float(os.environ.get('MEMCACHED_CONNECT_TIMEOUT', '1'))
+MEMCACHED_TIMEOUT = float(os.environ.get('MEMCACHED_TIMEOUT', '0.5'))
+MEMCACHED_POOL_SIZE = int(os.environ.get('MEMCACHED_POOL_SIZE', '4'))
 REGION = 'eu-west-1'
+# Stored for users that have no role, so repeated misses do not hit Slack every time.
+NO_ROLE = '-'
+NO_ROLE_TTL = int(os.environ.get('NO_ROLE_TTL', '300'))
+# Roles resolved on a cache miss expire so that the next sync stays the source of truth.
+LAZY_ROLE_TTL = int(os.environ.get('LAZY_ROLE_TTL', '3600'))
+# Per team role table written by Thaddeus, see thaddeus.py for the layout.
+ROLE_TABLE_KEY = '%s_roles'
+ROLE_LIST_KEY = '%s_roles_list_%s'
+ROLE_SHARD_KEY = '%s_roles_shard_%s'
+ROLE_SHARD_CACHE_SIZE = int(os.environ.get('ROLE_SHARD_CACHE_SIZE', '16'))
+# Role table answers kept in process memory, so a repeat lookup skips the shard fetch and
+# decode. Entries only hold for the generation they were read from.
+ROLE_LRU_SIZE = int(os.environ.get('ROLE_LRU_SIZE', '512'))
+SLACK_MESSAGE_LIMIT = 3500
+# A response_url accepts five replies, one of which goes to the "Wheels are in motion" notice.
+SLACK_MAX_MESSAGES = 4
+MAX_OUTPUT_BYTES = int(os.environ.get('MAX_OUTPUT_BYTES', '12000'))
+# In async mode the slash command only queues a job and `job_handler` runs it.
+ASYNC_MODE = os.environ.get('ALFRED_ASYNC', 'false').lower() == 'true'
+JOB_CONCURRENCY = int(os.environ.get('ALFRED_JOB_CONCURRENCY', '2'))
+# Stop picking up queued jobs once less than this is left of the lambda's time.
+JOB_TIME_RESERVE_MS = 60000
+# Opt-in cache for the output of read-only commands, keyed by role and argv.
+RESULT_CACHE = os.environ.get('ALFRED_RESULT_CACHE', 'false').lower() == 'true'
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('ALFRED_RESULT_CACHE_MAX_ENTRIES', '256'))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('ALFRED_RESULT_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+# (pattern on "service operation", ttl in seconds), first match wins. Extra rules can be
+# prepended as a JSON list of pairs in ALFRED_RESULT_CACHE_RULES. Anything unmatched is never cached.
+RESULT_CACHE_RULES = json.loads(os.environ.get('ALFRED_RESULT_CACHE_RULES', '[]')) + [
+    ['s3 ls', 30],
+    ['* describe-*', 60],
+    ['* list-*', 60],
+    ['* get-*', 60],
+]
+NO_CACHE_FLAG = '--no-cache'
+# Several commands can be sent in one invocation, separated by newlines or BATCH_SEPARATOR.
+BATCH_SEPARATOR = ';;'
+MAX_BATCH_COMMANDS = int(os.environ.get('ALFRED_MAX_BATCH_COMMANDS', '5'))
+BATCH_CONCURRENCY = int(os.environ.get('ALFRED_BATCH_CONCURRENCY', '3'))
+WORKER_MODE = os.environ.get('ALFRED_WORKER_MODE', 'false').lower() == 'true'
+WORKER_POOL_SIZE = int(os.environ.get('ALFRED_WORKER_POOL_SIZE', '2'))
+# Assumed role credentials are never handed out closer than this to expiry,
+# and get refreshed in the background once inside the refresh window.
+CREDENTIALS_EXPIRY_MARGIN = 120
+CREDENTIALS_REFRESH_WINDOW = 600
+
+
+_memcache_client = None
+
+
+def get_memcache_client():
+    # One pooled client per container, reused by every warm invocation.
+    global _memcache_client
+    if _memcache_client is None:
+        HashClient = profiling.lazy_import('pymemcache.client.hash').HashClient
+        with profiling.measure('setup', 'memcached'):
+            _memcache_client = HashClient([
+                (MEMCACHED_ENDPOINT, MEMCACHED_PORT)
+            ], connect_timeout=MEMCACHED_CONNECT_TIMEOUT,
+               timeout=MEMCACHED_TIMEOUT,
+               use_pooling=True,
+               max_pool_size=MEMCACHED_POOL_SIZE)
+    return _memcache_client
 
 
 class MemCacheHelper(object):
     def __init__(self):
-        self.client = HashClient([
-            (MEMCACHED_ENDPOINT, MEMCACHED_PORT)
-        ])
+        self.client = get_memcache_client()
 
-    def set(self, key, value):
-        self.client.set(key, value)
+    def set(self, key, value, expire=0):
+        self.client.set(key, value, expire=expire)
 
     def get(self, key):
         return self.client.get(key)
 
+    def get_many(self, keys):
+        return self.client.get_many(keys)
+
+
+class AwsWorker(object):
+    """Long lived `worker.py` process with awscli already imported."""
+
+    def __init__(self):
+        self.process = Popen(['/usr/bin/python', 'worker.py'], stdin=PIPE, stdout=PIPE)
+        self.warmup = None
+
+    def receive(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError('awscli worker exited unexpectedly')
+        return json.loads(line)
+
+    def run(self, task, env, output):
+        if self.warmup is None:
+            self.warmup = self.receive()['warmup']
+            log.info('awscli worker %s warmed up in %.3fs' % (self.process.pid, self.warmup))
+        self.process.stdin.write(json.dumps({'argv': task, 'env': env}) + '\n')
+        self.process.stdin.flush()
+        while True:
+            message = self.receive()
+            if 'line' not in message:
+                return message
+            # Once the output is truncated the rest is read and dropped.
+            output.write(message['line'].encode('utf-8'))
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        if self.is_alive():
+            self.process.kill()
+
+
+class AwsWorkerPool(object):
+    """Fixed size pool of awscli workers kept alive across warm invocations.
+
+    Workers are started as soon as the pool is created so their warm up
+    overlaps with the rest of the lambda cold start.
+    """
+
+    def __init__(self, size):
+        self.workers = Queue()
+        for _ in range(size):
+            self.workers.put(AwsWorker())
+
+    def run(self, task, env, output):
+        """Runs a command on the next free worker and returns its result."""
+        worker = self.workers.get()
+        try:
+            if not worker.is_alive():
+                worker = AwsWorker()
+            result = worker.run(task, env, output)
+        except Exception:
+            worker.close()
+            worker = AwsWorker()
+            raise
+        finally:
+            self.workers.put(worker)
+        # The spawn path pays the full awscli warm up on every command.
+        log.info('awscli worker ran command in %.3fs, saved ~%.3fs over spawning aws.py'
+                 % (result['elapsed'], worker.warmup))
+        return result
+
+
+worker_pool = AwsWorkerPool(WORKER_POOL_SIZE) if WORKER_MODE else None
+
+
+class CredentialCache(object):
+    """Assumed role credentials keyed by (role arn, team name).
+
+    Lives at module level so every invocation served by a warm container
+    shares it, along with a single STS client.
+    """
+
+    def __init__(self, expiry_margin, refresh_window):
+        self.expiry_margin = expiry_margin
+        self.refresh_window = refresh_window
+        self.credentials = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self._sts = None
+
+    @property
+    def sts(self):
+        if self._sts is None:
+            boto3 = profiling.lazy_import('boto3')
+            with profiling.measure('setup', 'sts'):
+                self._sts = boto3.client('sts')
+        return self._sts
+
+    def assume_role(self, role, team_name):
+        with metrics.span('assume_role'):
+            temp_creds = self.sts.assume_role(RoleArn=role,
+                                              RoleSessionName='alfredbot',
+                                              ExternalId=team_name)
+        credentials = temp_creds['Credentials']
+        with self.lock:
+            self.credentials[(role, team_name)] = credentials
+        return credentials
+
+    def refresh(self, role, team_name):
+        try:
+            self.assume_role(role, team_name)
+            log.info('Refreshed credentials for %s in the background' % role)
+        except Exception as e:
+            log.exception(e)
+        finally:
+            with self.lock:
+                self.refreshing.discard((role, team_name))
+
+    def get(self, role, team_name):
+        key = (role, team_name)
+        with self.lock:
+            credentials = self.credentials.get(key)
+        if not credentials or seconds_left(credentials) <= self.expiry_margin:
+            log.info('Assuming role %s' % role)
+            metrics.count('credentials_cache_miss')
+            return self.assume_role(role, team_name)
+
+        metrics.count('credentials_cache_hit')
+
+        if seconds_left(credentials) <= self.refresh_window:
+            with self.lock:
+                start_refresh = key not in self.refreshing
+                self.refreshing.add(key)
+            if start_refresh:
+                thread = threading.Thread(target=self.refresh, args=key)
+                thread.daemon = True
+                thread.start()
+        return credentials
+
+
+def seconds_left(credentials):
+    expiration = credentials['Expiration']
+    return (expiration - datetime.now(expiration.tzinfo)).total_seconds()
+
+
+credential_cache = CredentialCache(CREDENTIALS_EXPIRY_MARGIN, CREDENTIALS_REFRESH_WINDOW)
+
+
+def shard_of(user, shards):
+    return (zlib.crc32(user.encode('utf-8')) & 0xffffffff) % shards
+
+
+def unpack_shard(raw):
+    lines = zlib.decompress(raw).split('\n')
+    return dict((user, int(index)) for user, index in (line.split(' ') for line in lines if line))
+
+
+def read_pointer(raw):
+    if raw is None:
+        return 0, []
+    parts = raw.split()
+    if len(parts) < 3:
+        return int(parts[0]), []
+    return int(parts[0]), parts[1:]
+
+
+def read_override(raw, generation):
+    # Lazily resolved roles are tagged with the generation they were resolved against,
+    # so the next sync supersedes them. Untagged values predate the role table.
+    if raw and '|' in raw:
+        resolved_in, role = raw.split('|', 1)
+        if int(resolved_in) == generation:
+            return role
+    return None
+
+
+_role_shards = OrderedDict()
+_role_shards_lock = threading.Lock()
+
+
+def lookup_role_table(mc, team_id, digests, user_id):
+    list_digest, shard_digests = digests[0], digests[1:]
+    shard_digest = shard_digests[shard_of(user_id, len(shard_digests))]
+    key = (team_id, list_digest, shard_digest)
+    with _role_shards_lock:
+        cached = _role_shards.get(key)
+    if cached is None:
+        list_key = ROLE_LIST_KEY % (team_id, list_digest)
+        shard_key = ROLE_SHARD_KEY % (team_id, shard_digest)
+        values = mc.get_many([list_key, shard_key])
+        if len(values) != 2:
+            return None
+        cached = (json.loads(values[list_key]), unpack_shard(values[shard_key]))
+        # Keys are named by their content, so decoded shards never need invalidating and
+        # stay valid across generations that did not change them.
+        with _role_shards_lock:
+            _role_shards[key] = cached
+            while len(_role_shards) > ROLE_SHARD_CACHE_SIZE:
+                _role_shards.popitem(last=False)
+    role_list, users = cached
+    index = users.get(user_id)
+    return role_list[index] if index is not None else None
+
+
+class RoleCache(object):
+    """LRU of (team, user) -> role as read from the role table, bounded by entry count.
+
+    Every entry remembers the role table generation it was read from and is only
+    a hit while that is still the team's current generation.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, team_id, user_id, generation):
+        with self.lock:
+            entry = self.entries.pop((team_id, user_id), None)
+            if entry is None or entry[0] != generation:
+                return None
+            self.entries[(team_id, user_id)] = entry
+            return entry[1]
+
+    def put(self, team_id, user_id, generation, role):
+        with self.lock:
+            self.entries.pop((team_id, user_id), None)
+            self.entries[(team_id, user_id)] = (generation, role)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+role_cache = RoleCache(ROLE_LRU_SIZE)
+
 
 def get_role(team_id, user_id):
     mc = MemCacheHelper()
     unique_id = '%s_%s' % (team_id, user_id)
-    role = mc.get(unique_id)
+    table_key = ROLE_TABLE_KEY % team_id
+    try:
+        with metrics.span('get_role'):
+            # The pointer and override are read on every call, so a finished sync or a
+            # membership event is never answered from an older role.
+            values = mc.get_many([table_key, unique_id])
+            generation, digests = read_pointer(values.get(table_key))
+            role = read_override(values.get(unique_id), generation)
+            if role is None and digests:
+                role = role_cache.get(team_id, user_id, generation)
+                if role:
+                    metrics.count('role_lru_hit')
+                else:
+                    metrics.count('role_lru_miss')
+                    role = lookup_role_table(mc, team_id, digests, user_id)
+                    if role:
+                        role_cache.put(team_id, user_id, generation, role)
+    except Exception as e:
+        log.exception(e)
+        generation, role = 0, None
+    if role:
+        metrics.count('role_cache_hit')
+        return role if role != NO_ROLE else None
+
+    metrics.count('role_cache_miss')
+    log.info('No cached role for %s, resolving from mappings' % unique_id)
+    with metrics.span('resolve_role'):
+        role = profiling.lazy_import('resolver').resolve_role(team_id, user_id)
+    try:
+        if role:
+            mc.set(unique_id, '%s|%s' % (generation, role), expire=LAZY_ROLE_TTL)
+        else:
+            mc.set(unique_id, '%s|%s' % (generation, NO_ROLE), expire=NO_ROLE_TTL)
+    except Exception as e:
+        log.exception(e)
     return role
 
 def get_custom_env(role, team_name):
-    client = boto3.client('sts')
-    temp_creds = client.assume_role(RoleArn=role,
-                                    RoleSessionName='alfredbot',
-                                    ExternalId=team_name)
-    key = temp_creds['Credentials']['AccessKeyId']
-    secret = temp_creds['Credentials']['SecretAccessKey']
-    token = temp_creds['Credentials']['SessionToken']
+    credentials = credential_cache.get(role, team_name)
+    key = credentials['AccessKeyId']
+    secret = credentials['SecretAccessKey']
+    token = credentials['SessionToken']
     invoke_env = os.environ.copy()
     invoke_env["AWS_ACCESS_KEY_ID"] = str(key)
     invoke_env["AWS_SECRET_ACCESS_KEY"] = str(secret)
@@ -50,37 +387,383 @@ def get_custom_env(role, team_name):
     return invoke_env
 
 
-def invoke(team_name, team_id, user_id, task):
+class OutputStream(object):
+    """Posts command output to the response_url in line aligned chunks as it arrives.
+
+    Only the chunk being filled is held in memory and the total size is capped,
+    so memory stays flat whatever the size of the output.
+    """
+
+    def __init__(self, response_url, message_limit=SLACK_MESSAGE_LIMIT,
+                 max_messages=SLACK_MAX_MESSAGES, max_bytes=MAX_OUTPUT_BYTES):
+        self.response_url = response_url
+        self.message_limit = message_limit
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.chunk = []
+        self.chunk_size = 0
+        self.total = 0
+        self.posted = 0
+        self.truncated = False
+
+    def write(self, text):
+        """Returns False once the output has been truncated."""
+        for line in text.splitlines(True):
+            # A single line longer than a message is the only thing ever cut mid line.
+            for start in range(0, len(line), self.message_limit):
+                if not self.append(line[start:start + self.message_limit]):
+                    return False
+        return True
+
+    def append(self, piece):
+        if self.truncated or self.total + len(piece) > self.max_bytes:
+            self.truncated = True
+            return False
+        if self.chunk and self.chunk_size + len(piece) > self.message_limit:
+            # The last message is kept back so the truncation notice can go out with it.
+            if self.posted == self.max_messages - 1:
+                self.truncated = True
+                return False
+            self.flush()
+        self.chunk.append(piece)
+        self.chunk_size += len(piece)
+        self.total += len(piece)
+        return True
+
+    def flush(self):
+        self.post(''.join(self.chunk))
+        self.chunk = []
+        self.chunk_size = 0
+
+    def close(self):
+        if self.truncated:
+            self.chunk.append('\n_Output truncated after %s bytes._' % self.total)
+        if self.chunk or not self.posted:
+            self.chunk = self.chunk or ['Command finished with no output.']
+            self.flush()
+
+    def post(self, text):
+        log.info(text)
+        with metrics.span('post_output'):
+            sessions.get_session().post(self.response_url, json={'response_type': 'in_channel', 'text': text},
+                                        timeout=sessions.TIMEOUT)
+        self.posted += 1
+        metrics.count('messages_posted')
+        metrics.count('posted_bytes', len(text))
+
+
+def run_in_subprocess(task, env, output):
+    started = time.time()
+    polished_task = ['/usr/bin/python', 'aws.py'] + task
+    with metrics.span('command'):
+        p = Popen(polished_task, stdout=PIPE, stderr=STDOUT, env=env)
+        for line in iter(p.stdout.readline, ''):
+            if not output.write(line):
+                # Nothing more will be shown, so there is no point in letting the command run on.
+                p.kill()
+                break
+        p.stdout.close()
+        p.wait()
+    log.info('Spawned aws.py ran command in %.3fs' % (time.time() - started))
+    return p.returncode
+
+
+def run_in_worker(task, env, output):
+    with metrics.span('command'):
+        return worker_pool.run(task, env, output)['returncode']
+
+
+class ResultCache(object):
+    """LRU of read-only command output keyed by (role arn, team, normalized argv).
+
+    Bounded by entry count and total size; entries also expire after the
+    ttl of the rule that made them cacheable.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry['expires'] <= time.time():
+                self.size -= len(entry['output'])
+                return None
+            self.entries[key] = entry
+            return entry
+
+    def put(self, key, output, ttl):
+        if len(output) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous:
+                self.size -= len(previous['output'])
+            self.entries[key] = {'output': output, 'stored': time.time(), 'expires': time.time() + ttl}
+            self.size += len(output)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted['output'])
+
+
+class CommandOutput(object):
+    """Holds the output of one command of a batch until it is its turn to be posted."""
+
+    def __init__(self, max_bytes=MAX_OUTPUT_BYTES):
+        self.max_bytes = max_bytes
+        self.lines = []
+        self.size = 0
+        self.truncated = False
+
+    def write(self, text):
+        if self.truncated or self.size + len(text) > self.max_bytes:
+            self.truncated = True
+            return False
+        self.lines.append(text)
+        self.size += len(text)
+        return True
+
+
+class RecordingOutput(object):
+    """Passes output through to a stream while keeping a copy for the result cache."""
+
+    def __init__(self, output):
+        self.output = output
+        self.lines = []
+
+    def write(self, text):
+        written = self.output.write(text)
+        if written:
+            self.lines.append(text)
+        return written
+
+
+result_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_BYTES)
+
+
+def cache_ttl(task):
+    if len(task) < 2:
+        return None
+    operation = '%s %s' % (task[0].lower(), task[1].lower())
+    for pattern, ttl in RESULT_CACHE_RULES:
+        if fnmatch(operation, pattern):
+            return ttl
+    return None
+
+
+def cache_key(role, team_name, task):
+    # The team is part of the key like it is for credentials, since a hit skips assume_role
+    # and with it the ExternalId check that keeps one team off another team's role.
+    return (role, team_name, tuple([task[0].lower(), task[1].lower()] + task[2:]))
+
+
+def run_command(task, env, output):
+    if worker_pool:
+        return run_in_worker(task, env, output)
+    return run_in_subprocess(task, env, output)
+
+
+def invoke(team_name, team_id, user_id, tasks, output):
     role = get_role(team_id, user_id)
     log.info('Role for user %s is %s' % (user_id, role))
     if not role:
         return False, 'No role found for user. \n' \
                       'Please configure roles using `/alfred-admin` and then sync using `/alfred-sync`.'
+    if len(tasks) == 1:
+        return run_task(team_name, role, tasks[0], output)
+    return run_batch(team_name, role, tasks, output)
+
+
+def run_task(team_name, role, task, output):
+    use_cache = NO_CACHE_FLAG not in task
+    task = [arg for arg in task if arg != NO_CACHE_FLAG]
+    ttl = cache_ttl(task) if RESULT_CACHE else None
+    if ttl and use_cache:
+        cached = result_cache.get(cache_key(role, team_name, task))
+        if cached:
+            metrics.count('result_cache_hit')
+            output.write('_Cached result from %ds ago, add `%s` for a fresh one._\n'
+                         % (time.time() - cached['stored'], NO_CACHE_FLAG))
+            output.write(cached['output'])
+            return True, None
+        metrics.count('result_cache_miss')
     custom_env = get_custom_env(role, team_name)
 
     if task:
         log.info('Submitted task was {0}'.format(task))
-        polished_task = ['/usr/bin/python', 'aws.py'] + task
         try:
-            p = Popen(polished_task, stdout=PIPE, stderr=PIPE, env=custom_env)
-            stdout, stderr = p.communicate()
-            message = '%s\n%s' % (stdout, stderr)
-            log.info(message)
-            return True, message
+            if not ttl:
+                run_command(task, custom_env, output)
+                return True, None
+            recording = RecordingOutput(output)
+            returncode = run_command(task, custom_env, recording)
+            # Failed or truncated output is never cached.
+            if returncode == 0 and not output.truncated:
+                result_cache.put(cache_key(role, team_name, task), ''.join(recording.lines), ttl)
+            return True, None
         except Exception as e:
             log.exception(e)
             return False, 'Something went wrong. Try again later.'
 
 
+_batch_pool = None
+
+
+def get_batch_pool():
+    global _batch_pool
+    if _batch_pool is None:
+        _batch_pool = profiling.lazy_import('multiprocessing.pool').ThreadPool(BATCH_CONCURRENCY)
+    return _batch_pool
+
+
+def run_batch(team_name, role, tasks, output):
+    # Assumed once up front, so the commands running side by side all find it cached.
+    credential_cache.get(role, team_name)
+
+    def run(task):
+        buffered = CommandOutput()
+        try:
+            status, message = run_task(team_name, role, task, buffered)
+        except Exception as e:
+            log.exception(e)
+            status, message = False, 'Something went wrong. Try again later.'
+        return buffered, status, message
+
+    metrics.count('batch_commands', len(tasks))
+    # imap hands results back in order, so each command is posted as soon as it and all before it are done.
+    for task, (buffered, status, message) in zip(tasks, get_batch_pool().imap(run, tasks)):
+        output.write('*`aws %s`*\n' % ' '.join(task))
+        if not status:
+            output.write('%s\n' % message)
+        elif buffered.lines:
+            output.write(''.join(buffered.lines))
+            if not buffered.lines[-1].endswith('\n'):
+                output.write('\n')
+        else:
+            output.write('_No output._\n')
+        if buffered.truncated:
+            output.write('_Output of this command truncated after %s bytes._\n' % buffered.size)
+    return True, None
+
+
+def run_job(job):
+    output = OutputStream(job['response_url'])
+    try:
+        # Jobs queued before batches existed carry a single task.
+        tasks = job.get('tasks') or [job['task']]
+        status, message = invoke(job['team_name'], job['team_id'], job['user_id'], tasks, output)
+        if not status:
+            log.error(message)
+            output.write(message)
+    except Exception as e:
+        log.exception(e)
+        output.write('Something went wrong. Try again later.')
+    output.close()
+
+
+def run_queued_job(queue, item):
+    receipt, job = item
+    try:
+        run_job(job)
+    finally:
+        # Failed jobs are reported to the user rather than retried.
+        queue.ack(receipt)
+
+
+_job_pool = None
+
+
+def get_job_pool():
+    # Kept for the life of the container: closing a ThreadPool waits on its 0.1s polling loop.
+    global _job_pool
+    if _job_pool is None:
+        _job_pool = profiling.lazy_import('multiprocessing.pool').ThreadPool(JOB_CONCURRENCY)
+    return _job_pool
+
+
+def job_handler(event, context):
+    metrics.start()
+    try:
+        return drain_jobs(event, context)
+    finally:
+        sessions.report(metrics)
+        metrics.emit()
+
+
+def drain_jobs(event, context):
+    pool = get_job_pool()
+    if 'Records' in event:
+        # Invoked by an SQS event source, which deletes the messages once we return.
+        pool.map(run_job, [json.loads(record['body']) for record in event['Records']])
+        metrics.count('jobs_processed', len(event['Records']))
+        return {'processed': len(event['Records'])}
+
+    queue = profiling.lazy_import('jobs').get_queue()
+    processed = 0
+    batch = queue.get_batch(JOB_CONCURRENCY)
+    while batch:
+        pool.map(lambda item: run_queued_job(queue, item), batch)
+        processed += len(batch)
+        if context and context.get_remaining_time_in_millis() < JOB_TIME_RESERVE_MS:
+            break
+        batch = queue.get_batch(JOB_CONCURRENCY)
+    log.info('Processed %s queued jobs' % processed)
+    metrics.count('jobs_processed', processed)
+    return {'processed': processed}
+
+
+def mark_separators(raw_text):
+    # Unquoted newlines and BATCH_SEPARATORs become standalone separator tokens for shlex,
+    # quoted ones are left as they are and stay part of their argument.
+    chars, quote, escaped, index = [], None, False, 0
+    while index < len(raw_text):
+        char = raw_text[index]
+        if escaped:
+            escaped = False
+        elif char == '\\' and quote != "'":
+            escaped = True
+        elif quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '\n' or raw_text.startswith(BATCH_SEPARATOR, index):
+            chars.append(' %s ' % BATCH_SEPARATOR)
+            index += 1 if char == '\n' else len(BATCH_SEPARATOR)
+            continue
+        chars.append(char)
+        index += 1
+    return ''.join(chars)
+
+
+def parse_commands(raw_text):
+    commands = [[]]
+    for token in shlex.split(mark_separators(raw_text)):
+        if token == BATCH_SEPARATOR:
+            commands.append([])
+        else:
+            commands[-1].append(token)
+    return [command for command in commands if command]
+
+
 def bot_help():
     h = "Available commands `/alfred-invoke <aws command> `\n"
     h += "\nExample: `/alfred-invoke aws s3 ls `"
+    h += "\nSeveral commands can be run at once, one per line or separated by `%s`." % BATCH_SEPARATOR
     h += "\n"
     h += "\n For more details see www.alfredbot.io/"
     return h
 
 
 def handler(event, context):
+    started = time.time()
+    metrics.start()
     try:
         resp = None
         log.info(event)
@@ -89,28 +772,41 @@ def handler(event, context):
         team_id = event['team_id']
         user_id = event['user_id']
         response_url = event['response_url']
-        args = shlex.split(raw_text)
-        if args[0] != 'aws':
-            message = 'Unsuported command %s\n\n' % args[0]
+        commands = parse_commands(raw_text)
+        unsupported = [args[0] for args in commands if args[0] != 'aws']
+        if unsupported or not commands:
+            message = 'Unsuported command %s\n\n' % (unsupported or [raw_text])[0]
             message += bot_help()
             log.error(message)
+        elif len(commands) > MAX_BATCH_COMMANDS:
+            message = 'At most %s commands can be run at once.' % MAX_BATCH_COMMANDS
+            log.error(message)
+        elif ASYNC_MODE:
+            profiling.lazy_import('jobs').get_queue().put({'team_name': team_name,
+                                  'team_id': team_id,
+                                  'user_id': user_id,
+                                  'tasks': [args[1:] for args in commands],
+                                  'response_url': response_url})
+            message = 'Queued `%s`, results will be posted here.' % raw_text
         else:
             # Somewhat workaround to slackbot timeout
             message = 'Wheels are in motion, sorry if this might take a bit.'
-            requests.post(response_url, json={'text': message})
-            status, message = invoke(team_name, team_id, user_id, args[1:])
+            with metrics.span('post_ack'):
+                sessions.get_session().post(response_url, json={'text': message}, timeout=sessions.TIMEOUT)
+            output = OutputStream(response_url)
+            status, message = invoke(team_name, team_id, user_id, [args[1:] for args in commands], output)
             if not status:
                 log.error(message)
-            resp = {
-                "response_type": "in_channel",
-                'text': message
-            }
-            requests.post(response_url,
-                          json=resp)
+                output.write(message)
+            output.close()
+            resp = output
     except Exception as e:
         log.exception(e)
         message = e.message
     finally:
+        profiling.report(started)
+        sessions.report(metrics)
+        metrics.emit()
         if not resp:
             return {
                 'text': message
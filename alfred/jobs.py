@@ -0,0 +1,107 @@
+"""Job queues for asynchronous `/alfred-invoke` commands.
+
+Every backend stores jobs as JSON documents and exposes the same three calls:
+`put(job)`, `get_batch(max_jobs)` returning (receipt, job) pairs, and
+`ack(receipt)` once a job has been handled. SQS is used in AWS, SQLite and
+memory are stand-ins for running locally.
+"""
+import json
+import os
+import sqlite3
+import threading
+from collections import deque
+
+QUEUE_BACKEND = os.environ.get('ALFRED_QUEUE', 'sqs')
+QUEUE_URL = os.environ.get('ALFRED_QUEUE_URL')
+QUEUE_PATH = os.environ.get('ALFRED_QUEUE_PATH', '/tmp/alfred-jobs.db')
+# SQS hands out at most ten messages per receive call.
+SQS_MAX_MESSAGES = 10
+
+
+class MemoryQueue(object):
+    def __init__(self):
+        self.jobs = deque()
+        self.lock = threading.Lock()
+
+    def put(self, job):
+        with self.lock:
+            self.jobs.append(json.dumps(job))
+
+    def get_batch(self, max_jobs):
+        batch = []
+        with self.lock:
+            while self.jobs and len(batch) < max_jobs:
+                batch.append((None, json.loads(self.jobs.popleft())))
+        return batch
+
+    def ack(self, receipt):
+        pass
+
+
+class SqliteQueue(object):
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS jobs '
+                       '(id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT, taken INTEGER DEFAULT 0)')
+
+    def connect(self):
+        # One connection per call keeps the queue usable from worker threads.
+        return sqlite3.connect(self.path, timeout=10)
+
+    def put(self, job):
+        with self.connect() as db:
+            db.execute('INSERT INTO jobs (body) VALUES (?)', (json.dumps(job),))
+
+    def get_batch(self, max_jobs):
+        db = self.connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute('SELECT id, body FROM jobs WHERE taken = 0 ORDER BY id LIMIT ?',
+                              (max_jobs,)).fetchall()
+            db.executemany('UPDATE jobs SET taken = 1 WHERE id = ?', [(row[0],) for row in rows])
+            db.commit()
+        finally:
+            db.close()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def ack(self, receipt):
+        with self.connect() as db:
+            db.execute('DELETE FROM jobs WHERE id = ?', (receipt,))
+
+
+class SqsQueue(object):
+    def __init__(self, queue_url):
+        import boto3
+        self.queue_url = queue_url
+        self.sqs = boto3.client('sqs')
+
+    def put(self, job):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(job))
+
+    def get_batch(self, max_jobs):
+        response = self.sqs.receive_message(QueueUrl=self.queue_url,
+                                            MaxNumberOfMessages=min(max_jobs, SQS_MAX_MESSAGES),
+                                            WaitTimeSeconds=0)
+        return [(message['ReceiptHandle'], json.loads(message['Body']))
+                for message in response.get('Messages', [])]
+
+    def ack(self, receipt):
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+
+_queue = None
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        if QUEUE_BACKEND == 'memory':
+            _queue = MemoryQueue()
+        elif QUEUE_BACKEND == 'sqlite':
+            _queue = SqliteQueue(QUEUE_PATH)
+        elif QUEUE_BACKEND == 'sqs':
+            _queue = SqsQueue(QUEUE_URL)
+        else:
+            raise ValueError('Unsupported job queue %s' % QUEUE_BACKEND)
+    return _queue
@@ -0,0 +1,45 @@
+"""Cold start profiling.
+
+Heavy modules are imported through `lazy_import` the first time they are
+needed. With ALFRED_PROFILE_STARTUP=true every such import and every first
+client construction wrapped in `measure` is timed, and `report` logs the
+timings collected since the previous report as one JSON line.
+"""
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger()
+
+ENABLED = os.environ.get('ALFRED_PROFILE_STARTUP', 'false').lower() == 'true'
+timings = []
+
+
+@contextmanager
+def measure(kind, name):
+    started = time.time()
+    try:
+        yield
+    finally:
+        if ENABLED:
+            timings.append({'kind': kind, 'name': name, 'seconds': round(time.time() - started, 4)})
+
+
+def lazy_import(name):
+    module = sys.modules.get(name)
+    if module is None:
+        with measure('import', name):
+            module = importlib.import_module(name)
+    return module
+
+
+def report(handler_started):
+    if not ENABLED or not timings:
+        return
+    log.info(json.dumps({'startup_profile': timings,
+                         'handler_seconds': round(time.time() - handler_started, 4)}))
+    del timings[:]
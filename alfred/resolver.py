@@ -0,0 +1,174 @@
+"""On demand role resolution for users missing from the role cache.
+
+Only imported on a cache miss, so pynamodb, slacker and the KMS client are
+kept off the hot path of every other invocation.
+"""
+import base64
+import logging
+import os
+import time
+
+import boto3
+from pynamodb.attributes import NumberAttribute, UnicodeAttribute
+from pynamodb.indexes import GlobalSecondaryIndex, AllProjection
+from pynamodb.models import Model
+from requests.exceptions import HTTPError
+from slacker import Error as SlackError, Slacker
+
+import profiling
+import sessions
+
+log = logging.getLogger()
+
+CONFIG_TABLE_NAME = 'alfredbot-configuration'
+TOKEN_TABLE_NAME = 'alfredbot-token'
+REGION = 'eu-west-1'
+TOKEN_TTL = int(os.environ.get('TOKEN_TTL', '900'))
+SLACK_PAGE_SIZE = 200
+SLACK_MAX_RETRIES = 5
+# Slack errors meaning the cached token is no longer valid.
+TOKEN_ERRORS = ['invalid_auth', 'not_authed', 'token_revoked', 'account_inactive']
+# Slack errors that only concern one mapping. Anything else is raised, so that a
+# failure is never cached as the user having no role.
+MEMBERSHIP_ERRORS = ['channel_not_found', 'not_in_channel']
+
+
+class ViewIndex(GlobalSecondaryIndex):
+    class Meta:
+        read_capacity_units = 1
+        write_capacity_units = 1
+        index_name = 'team_id-index'
+        projection = AllProjection()
+
+    team_id = UnicodeAttribute(hash_key=True)
+
+
+class TeamConfigModel(Model):
+    class Meta:
+        table_name = CONFIG_TABLE_NAME
+        region = REGION
+
+    id = UnicodeAttribute(hash_key=True)
+    team_id_index = ViewIndex()
+    friendly_name = UnicodeAttribute()
+    team_id = UnicodeAttribute()
+    type = UnicodeAttribute()
+    arn = UnicodeAttribute()
+    priority = NumberAttribute()
+
+
+class TeamModel(Model):
+    class Meta:
+        table_name = TOKEN_TABLE_NAME
+        region = REGION
+
+    team_id = UnicodeAttribute(hash_key=True)
+    token = UnicodeAttribute()
+
+
+class TokenCache(object):
+    """Decrypted slack tokens kept in memory across warm invocations."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.tokens = {}
+
+    def get(self, team_id):
+        cached = self.tokens.get(team_id)
+        if cached and cached['expires'] > time.time():
+            return cached['token']
+
+        try:
+            team = TeamModel.get(team_id)
+        except TeamModel.DoesNotExist:
+            return None
+        token = decrypt(team.token)
+        self.tokens[team_id] = {'token': token, 'expires': time.time() + self.ttl}
+        return token
+
+    def invalidate(self, team_id):
+        self.tokens.pop(team_id, None)
+
+
+_kms_client = None
+
+
+def get_kms_client():
+    global _kms_client
+    if _kms_client is None:
+        with profiling.measure('setup', 'kms'):
+            _kms_client = boto3.client('kms')
+    return _kms_client
+
+
+def decrypt(cipher_text):
+    res = get_kms_client().decrypt(CiphertextBlob=base64.b64decode(cipher_text))
+    return res.get('Plaintext')
+
+
+token_cache = TokenCache(TOKEN_TTL)
+
+
+def slack_call(slack, method, **params):
+    # Slack answers 429 with a Retry-After header once a method's rate limit tier is exhausted.
+    for attempt in range(SLACK_MAX_RETRIES):
+        try:
+            return slack.api.get(method, params=params).body
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 429 or attempt == SLACK_MAX_RETRIES - 1:
+                raise
+            delay = float(e.response.headers.get('Retry-After', 2 ** attempt))
+            log.info('Rate limited on %s, retrying in %ss' % (method, delay))
+            time.sleep(delay)
+
+
+def paginate(slack, method, key, **params):
+    items = []
+    while True:
+        body = slack_call(slack, method, limit=SLACK_PAGE_SIZE, **params)
+        items.extend(body[key])
+        cursor = body.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return items
+        params['cursor'] = cursor
+
+
+def fetch_usergroup_members(slack, config):
+    try:
+        return slack_call(slack, 'usergroups.users.list', usergroup=config.id)['users']
+    except SlackError as e:
+        if str(e) not in MEMBERSHIP_ERRORS:
+            raise
+        log.error('Could not fetch members of %s %s: %s' % (config.type, config.friendly_name, e))
+        return []
+
+
+def fetch_user_conversations(slack, user_id):
+    return set(conversation['id'] for conversation in
+               paginate(slack, 'users.conversations', 'channels', user=user_id,
+                        types='public_channel,private_channel', exclude_archived=True))
+
+
+def resolve_role(team_id, user_id):
+    # Same rules as a Thaddeus sync, for a single user: the strongest (lowest priority)
+    # mapping the user is a member of wins. Channels are checked against the user's own
+    # conversations, so the cost no longer grows with the size of the mapped channels.
+    token = token_cache.get(team_id)
+    if not token:
+        return None
+    slack = Slacker(token, session=sessions.get_session())
+    configs = sorted(TeamConfigModel.team_id_index.query(team_id), key=lambda config: config.priority)
+    try:
+        usergroups = dict((config.id, set(fetch_usergroup_members(slack, config)))
+                          for config in configs if config.type == 'usergroup')
+        conversations = set()
+        if len(usergroups) < len(configs):
+            conversations = fetch_user_conversations(slack, user_id)
+    except SlackError as e:
+        if str(e) in TOKEN_ERRORS:
+            log.info('Dropping cached token for team %s: %s' % (team_id, e))
+            token_cache.invalidate(team_id)
+        raise
+    best = next((config for config in configs
+                 if config.id in conversations or user_id in usergroups.get(config.id, ())), None)
+    return best.arn if best else None
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+"""Pre-warmed awscli worker.
+
+Imports awscli and builds its command table once, then serves commands sent
+as JSON lines on stdin. Every command runs in a forked child with its own
+environment, so the assumed-role credentials of one command never leak into
+the next one. Output is relayed as one `line` message per output line,
+followed by a final message with the return code.
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import time
+
+
+def warm_up():
+    started = time.time()
+    import awscli.clidriver
+    driver = awscli.clidriver.create_clidriver()
+    # Building the command table loads the botocore service models,
+    # which is the expensive part of every awscli start.
+    driver._get_command_table()
+    return driver, time.time() - started
+
+
+def run(driver, argv, env, channel):
+    """Run one command in a forked child, relaying its output line by line."""
+    started = time.time()
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        returncode = 255
+        try:
+            os.close(read_end)
+            os.dup2(write_end, sys.stdout.fileno())
+            os.dup2(write_end, sys.stderr.fileno())
+            os.environ.clear()
+            os.environ.update(env)
+            returncode = driver.main(argv)
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else 255
+        except Exception as e:
+            print(e, file=sys.stderr)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(returncode or 0)
+
+    os.close(write_end)
+    output = os.fdopen(read_end)
+    for line in iter(output.readline, ''):
+        send(channel, {'line': line.decode('utf-8', 'replace')})
+    output.close()
+    _, status = os.waitpid(pid, 0)
+    return {'returncode': os.WEXITSTATUS(status),
+            'elapsed': time.time() - started}
+
+
+def send(channel, message):
+    channel.write(json.dumps(message) + '\n')
+    channel.flush()
+
+
+def serve(driver, warmup):
+    # Keep a private handle on the real stdout for the protocol and point
+    # fd 1 at /dev/null, so nothing awscli prints can corrupt the channel.
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    send(channel, {'ready': True, 'warmup': warmup})
+    for line in iter(sys.stdin.readline, ''):
+        request = json.loads(line)
+        send(channel, run(driver, request['argv'], request['env'], channel))
+
+
+def main():
+    driver, warmup = warm_up()
+    serve(driver, warmup)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""Measure cold start time to first response for each lambda module.
+
+Every sample imports the module in a fresh interpreter and calls its handler
+with an event that takes a help or error path, so no AWS or Slack call is
+made and only import and setup cost is measured.
+
+Usage: python benchmarks/cold_start.py [runs]
+"""
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+EVENTS = {
+    'alfred': {'text': 'help', 'team_domain': 'bench', 'team_id': 'T0', 'user_id': 'U0',
+               'response_url': 'http://localhost/'},
+    'eagle': {'text': 'help', 'team_id': 'T0', 'user_id': 'U0'},
+    'thaddeus': {},
+    'outsider': {},
+}
+
+SAMPLE = '''
+import json, sys, time
+started = time.time()
+sys.path.insert(0, sys.argv[1])
+import logging
+logging.disable(logging.CRITICAL)
+module = __import__(sys.argv[2])
+imported = time.time()
+module.handler(json.loads(sys.argv[3]), None)
+print(json.dumps({'import': imported - started, 'first_response': time.time() - started,
+                  'modules': len(sys.modules)}))
+'''
+
+
+def sample(name):
+    output = subprocess.check_output([sys.executable, '-c', SAMPLE,
+                                      os.path.join(ROOT, name), name, json.dumps(EVENTS[name])],
+                                     cwd=os.path.join(ROOT, name))
+    return json.loads(output.splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('%-10s %10s %16s %8s' % ('lambda', 'import', 'first response', 'modules'))
+    for name in sorted(EVENTS):
+        samples = [sample(name) for _ in range(runs)]
+        print('%-10s %9.3fs %15.3fs %8d' % (name,
+                                            median([s['import'] for s in samples]),
+                                            median([s['first_response'] for s in samples]),
+                                            samples[-1]['modules']))
+
+
+if __name__ == '__main__':
+    main()
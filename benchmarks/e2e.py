@@ -0,0 +1,134 @@
+"""Offline end-to-end latency benchmark for all four lambda handlers.
+
+Runs every handler against the stand-ins in benchmarks/fakes.py, with the
+per-service latency injected there, and reports p50/p95/p99 per handler and
+per stage for each workspace size. Handlers are invoked repeatedly in one
+process, so the numbers are those of a warm container after its first call.
+
+Usage: python benchmarks/e2e.py [--sizes 10,1000,100000] [--runs 20]
+                                [--latency service=seconds ...] [--scale 1.0]
+"""
+from __future__ import print_function
+
+import argparse
+import importlib
+import logging
+import os
+import random
+import sys
+import time
+
+import fakes
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+TEAM_ID = 'T0BENCH'
+ROLE = 'arn:aws:iam::123456789012:role/alfredbot-%s'
+MAPPINGS = [('C0GENERAL', 'general', 'channel', 'readonly', 3),
+            ('C0OPS', 'ops', 'channel', 'ops', 2),
+            ('G0ADMINS', 'admins', 'group', 'admin', 1),
+            ('S0ONCALL', 'oncall', 'usergroup', 'ops', 2)]
+
+
+def load(name):
+    sys.path.insert(0, os.path.join(ROOT, name))
+    return importlib.import_module(name)
+
+
+def stub_awscli(alfred):
+    def run_in_subprocess(task, env, output):
+        fakes.recorder.call('awscli')
+        output.write(('%s\n' % ' '.join(task)) * 20)
+    alfred.run_in_subprocess = run_in_subprocess
+
+
+def seed(eagle, members):
+    fakes.workspace = fakes.Workspace(members)
+    fakes.tables.clear()
+    fakes.HashClient.store.clear()
+    eagle.TeamModel(team_id=TEAM_ID, token=fakes.encrypt_token('xoxb-bench')).save()
+    for id, name, type, role, priority in MAPPINGS:
+        eagle.TeamConfigModel(id=id, friendly_name=name, team_id=TEAM_ID, type=type,
+                              arn=ROLE % role, priority=priority).save()
+
+
+def scenarios(modules):
+    alfred, eagle, outsider, thaddeus = modules
+
+    def invoke():
+        user = random.choice(fakes.workspace.members)
+        alfred.handler({'text': 'aws ec2 describe-instances', 'team_domain': 'bench',
+                        'team_id': TEAM_ID, 'user_id': user, 'user_name': user,
+                        'response_url': 'https://hooks.slack.com/bench'}, None)
+
+    def admin():
+        admin = sorted(fakes.workspace.admins)[0]
+        eagle.handler({'text': 'add channel channel-%d %s 5' % (random.randrange(50), ROLE % 'readonly'),
+                       'team_id': TEAM_ID, 'user_id': admin, 'user_name': admin}, None)
+
+    def sync():
+        thaddeus.handler({'team_id': TEAM_ID}, None)
+
+    def install():
+        outsider.handler({'params': {'querystring': {'code': 'bench'}}}, None)
+
+    return [('thaddeus', sync), ('alfred', invoke), ('eagle', admin), ('outsider', install)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1)]
+
+
+def report(size, samples):
+    print('\n== %s members ==' % size)
+    print('%-10s %-10s %9s %9s %9s' % ('handler', 'stage', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for handler, runs in samples:
+        stages = sorted(set(stage for run in runs for stage in run if stage != 'total'))
+        for stage in ['total'] + stages:
+            values = [run.get(stage, 0) * 1000 for run in runs]
+            print('%-10s %-10s %9.1f %9.1f %9.1f' % (handler, stage, percentile(values, 50),
+                                                     percentile(values, 95), percentile(values, 99)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10,1000,100000')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for every injected latency')
+    parser.add_argument('--latency', action='append', default=[], metavar='SERVICE=SECONDS')
+    args = parser.parse_args()
+
+    for override in args.latency:
+        service, seconds = override.split('=')
+        fakes.recorder.latency[service] = float(seconds)
+    for service in fakes.recorder.latency:
+        fakes.recorder.latency[service] *= args.scale
+
+    logging.disable(logging.CRITICAL)
+    fakes.install()
+    modules = [load(name) for name in ('alfred', 'eagle', 'outsider', 'thaddeus')]
+    stub_awscli(modules[0])
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        seed(modules[1], size)
+        samples = []
+        for handler, scenario in scenarios(modules):
+            runs = []
+            for _ in range(args.runs):
+                fakes.recorder.reset()
+                started = time.time()
+                # Handlers print their metrics line, and Outsider the event it receives.
+                stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+                try:
+                    scenario()
+                finally:
+                    sys.stdout = stdout
+                stages = fakes.recorder.reset()
+                stages['total'] = time.time() - started
+                runs.append(stages)
+            samples.append((handler, runs))
+        report(size, samples)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,484 @@
+"""In-process stand-ins for every external service the lambdas talk to.
+
+`install()` registers fake `boto3`, `pynamodb`, `slacker`, `pymemcache`,
+`requests` and `tabulate` modules in `sys.modules`, so the lambda modules can
+be imported and run offline. Every fake call sleeps for the latency
+configured for its service and records the time under that service's stage
+in `recorder`.
+"""
+import base64
+import json
+import sys
+import threading
+import time
+import types
+from collections import defaultdict
+
+DEFAULT_LATENCY = {
+    'slack': 0.030,
+    'dynamodb': 0.008,
+    'kms': 0.015,
+    'sts': 0.120,
+    's3': 0.020,
+    'sqs': 0.010,
+    'memcached': 0.001,
+    'http': 0.040,
+    'awscli': 0.400,
+}
+
+
+class Recorder(object):
+    """Collects the time spent per stage during one handler invocation."""
+
+    def __init__(self):
+        self.latency = dict(DEFAULT_LATENCY)
+        self.stages = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def call(self, stage):
+        started = time.time()
+        time.sleep(self.latency.get(stage, 0))
+        with self.lock:
+            self.stages[stage] += time.time() - started
+
+    def reset(self):
+        stages = dict(self.stages)
+        self.stages.clear()
+        return stages
+
+
+recorder = Recorder()
+
+
+class Workspace(object):
+    """Synthetic Slack workspace with a fixed set of configured channels."""
+
+    def __init__(self, members, filler_channels=50):
+        self.members = ['U%07d' % i for i in range(members)]
+        self.admins = set(self.members[:max(1, members // 100)])
+        subset = lambda fraction: self.members[:max(1, int(members * fraction))]
+        self.channels = {'C0GENERAL': ('general', self.members),
+                         'C0OPS': ('ops', subset(0.1))}
+        for i in range(filler_channels):
+            self.channels['C%07d' % i] = ('channel-%d' % i, subset(0.01))
+        self.groups = {'G0ADMINS': ('admins', subset(0.01))}
+        self.usergroups = {'S0ONCALL': ('oncall', subset(0.02))}
+
+    def conversation(self, id):
+        return self.channels.get(id) or self.groups.get(id)
+
+
+workspace = Workspace(10)
+
+
+# slacker
+
+class SlackError(Exception):
+    pass
+
+
+class Response(object):
+    def __init__(self, body):
+        self.body = body
+
+
+def page(items, params, key):
+    limit = int(params.get('limit') or 100)
+    start = int(params.get('cursor') or 0)
+    body = {'ok': True, key: items[start:start + limit]}
+    if start + limit < len(items):
+        body['response_metadata'] = {'next_cursor': str(start + limit)}
+    return body
+
+
+def listing(entries, exclude_members):
+    return [dict({'id': id, 'name': name}, **({} if exclude_members else {'members': members}))
+            for id, (name, members) in sorted(entries.items())]
+
+
+class FakeSlackApi(object):
+    def get(self, method, params=None, **kwargs):
+        recorder.call('slack')
+        params = params or {}
+        exclude_members = params.get('exclude_members')
+        if method == 'conversations.members':
+            conversation = workspace.conversation(params['channel'])
+            if conversation is None:
+                raise SlackError('channel_not_found')
+            return Response(page(conversation[1], params, 'members'))
+        if method == 'channels.list':
+            return Response(page(listing(workspace.channels, exclude_members), params, 'channels'))
+        if method == 'groups.list':
+            return Response(page(listing(workspace.groups, exclude_members), params, 'groups'))
+        if method == 'usergroups.list':
+            return Response({'ok': True, 'usergroups': listing(workspace.usergroups, True)})
+        if method == 'usergroups.users.list':
+            return Response({'ok': True, 'users': workspace.usergroups[params['usergroup']][1]})
+        if method == 'users.info':
+            return Response(user_info(params['user']))
+        if method == 'users.conversations':
+            channels = [{'id': id} for id, (_, members) in
+                        sorted(workspace.channels.items() + workspace.groups.items())
+                        if params['user'] in members]
+            return Response(page(channels, params, 'channels'))
+        if method == 'users.list':
+            users = [user_info(user)['user'] for user in workspace.members]
+            return Response(page(users, params, 'members'))
+        raise SlackError('unknown_method')
+
+    post = get
+
+
+def user_info(user_id):
+    admin = user_id in workspace.admins
+    return {'ok': True, 'user': {'id': user_id, 'is_admin': admin, 'is_owner': False}}
+
+
+class FakeUsers(object):
+    def info(self, user_id):
+        recorder.call('slack')
+        return Response(user_info(user_id))
+
+
+class FakeOAuth(object):
+    def access(self, client_id, client_secret, code):
+        recorder.call('slack')
+        return Response({'ok': True, 'team_id': 'T0BENCH', 'access_token': 'xoxb-%s' % code})
+
+
+class Slacker(object):
+    def __init__(self, token, **kwargs):
+        self.token = token
+        self.api = FakeSlackApi()
+        self.users = FakeUsers()
+        self.oauth = FakeOAuth()
+
+
+# pymemcache
+
+class HashClient(object):
+    store = {}
+
+    def __init__(self, servers, **kwargs):
+        pass
+
+    def get(self, key, default=None):
+        recorder.call('memcached')
+        return self.store.get(key, default)
+
+    def get_many(self, keys):
+        recorder.call('memcached')
+        return dict((key, self.store[key]) for key in keys if key in self.store)
+
+    def set(self, key, value, expire=0, noreply=None):
+        recorder.call('memcached')
+        self.store[key] = value
+        return True
+
+    def set_many(self, values, expire=0, noreply=None):
+        recorder.call('memcached')
+        self.store.update(values)
+        return []
+
+    def add(self, key, value, expire=0, noreply=None):
+        recorder.call('memcached')
+        if key in self.store:
+            return False
+        self.store[key] = value
+        return True
+
+    def incr(self, key, value, noreply=False):
+        recorder.call('memcached')
+        if key not in self.store:
+            return None
+        self.store[key] = str(int(self.store[key]) + value)
+        return int(self.store[key])
+
+    def delete(self, key, noreply=None):
+        recorder.call('memcached')
+        return self.store.pop(key, None) is not None
+
+    def touch(self, key, expire=0, noreply=None):
+        recorder.call('memcached')
+        return key in self.store
+
+    def delete_many(self, keys, noreply=None):
+        recorder.call('memcached')
+        for key in keys:
+            self.store.pop(key, None)
+        return True
+
+
+# pynamodb
+
+tables = defaultdict(dict)
+
+
+class Attribute(object):
+    def __init__(self, hash_key=False, range_key=False, null=False, default=None, **kwargs):
+        self.hash_key = hash_key
+        self.default = default
+
+
+class GlobalSecondaryIndex(object):
+    model = None
+
+    def query(self, hash_key, **kwargs):
+        recorder.call('dynamodb')
+        key = [name for name, value in vars(type(self)).items()
+               if isinstance(value, Attribute) and value.hash_key][0]
+        return iter([item for item in tables[self.model.Meta.table_name].values()
+                     if getattr(item, key) == hash_key])
+
+
+class AllProjection(object):
+    pass
+
+
+class DoesNotExist(Exception):
+    pass
+
+
+class ModelMeta(type):
+    def __init__(cls, name, bases, attrs):
+        super(ModelMeta, cls).__init__(name, bases, attrs)
+        for value in attrs.values():
+            if isinstance(value, GlobalSecondaryIndex):
+                value.model = cls
+        hash_keys = [key for key, value in attrs.items() if isinstance(value, Attribute) and value.hash_key]
+        if hash_keys:
+            cls._hash_key = hash_keys[0]
+
+
+class BatchWrite(object):
+    def __init__(self, model):
+        self.model = model
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        recorder.call('dynamodb')
+
+    def save(self, item):
+        tables[self.model.Meta.table_name][getattr(item, self.model._hash_key)] = item
+
+    def delete(self, item):
+        tables[self.model.Meta.table_name].pop(getattr(item, self.model._hash_key), None)
+
+
+class Model(object):
+    __metaclass__ = ModelMeta
+    DoesNotExist = DoesNotExist
+
+    def __init__(self, hash_key=None, **attributes):
+        for name, value in vars(type(self)).items():
+            if isinstance(value, Attribute):
+                setattr(self, name, value.default)
+        for name, value in attributes.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def get(cls, hash_key):
+        recorder.call('dynamodb')
+        try:
+            return tables[cls.Meta.table_name][hash_key]
+        except KeyError:
+            raise cls.DoesNotExist()
+
+    @classmethod
+    def query(cls, hash_key, **filters):
+        recorder.call('dynamodb')
+        item = tables[cls.Meta.table_name].get(hash_key)
+        for name, value in filters.items():
+            if item is not None and getattr(item, name.split('__')[0]) != value:
+                item = None
+        return iter([item] if item is not None else [])
+
+    @classmethod
+    def scan(cls, **kwargs):
+        recorder.call('dynamodb')
+        return iter(list(tables[cls.Meta.table_name].values()))
+
+    @classmethod
+    def batch_write(cls):
+        return BatchWrite(cls)
+
+    def save(self):
+        recorder.call('dynamodb')
+        tables[self.Meta.table_name][getattr(self, self._hash_key)] = self
+
+    def delete(self):
+        recorder.call('dynamodb')
+        tables[self.Meta.table_name].pop(getattr(self, self._hash_key), None)
+
+
+# boto3
+
+class FakeSts(object):
+    def assume_role(self, RoleArn, RoleSessionName, ExternalId=None, **kwargs):
+        from datetime import datetime, timedelta
+        recorder.call('sts')
+        return {'Credentials': {'AccessKeyId': 'ASIABENCH', 'SecretAccessKey': 'secret',
+                                'SessionToken': 'token',
+                                'Expiration': datetime.now(UTC) + timedelta(hours=1)}}
+
+
+class FakeKms(object):
+    def encrypt(self, KeyId, Plaintext):
+        recorder.call('kms')
+        return {'CiphertextBlob': 'kms:' + Plaintext}
+
+    def decrypt(self, CiphertextBlob):
+        recorder.call('kms')
+        return {'Plaintext': CiphertextBlob[len('kms:'):]}
+
+
+class FakeSqs(object):
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody):
+        recorder.call('sqs')
+        self.messages.append(MessageBody)
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, **kwargs):
+        recorder.call('sqs')
+        batch, self.messages = self.messages[:MaxNumberOfMessages], self.messages[MaxNumberOfMessages:]
+        return {'Messages': [{'ReceiptHandle': str(i), 'Body': body} for i, body in enumerate(batch)]}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        recorder.call('sqs')
+
+
+class FakeS3Object(object):
+    def get(self):
+        recorder.call('s3')
+        return {'Body': FakeBody(json.dumps({'client_id': 'bench', 'client_secret': 'bench', 'signing_secret': 'bench'}))}
+
+
+class FakeBody(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakeS3(object):
+    def Object(self, bucket, key):
+        return FakeS3Object()
+
+
+CLIENTS = {'sts': FakeSts, 'kms': FakeKms, 'sqs': FakeSqs}
+
+
+def boto3_client(name, **kwargs):
+    return CLIENTS[name]()
+
+
+def boto3_resource(name, **kwargs):
+    return FakeS3()
+
+
+def _utc():
+    from datetime import timedelta, tzinfo
+
+    class Utc(tzinfo):
+        def utcoffset(self, dt):
+            return timedelta(0)
+
+        def dst(self, dt):
+            return timedelta(0)
+
+        def tzname(self, dt):
+            return 'UTC'
+    return Utc()
+
+
+UTC = _utc()
+
+
+# requests
+
+class HTTPError(Exception):
+    def __init__(self, *args, **kwargs):
+        self.response = kwargs.pop('response', None)
+        super(HTTPError, self).__init__(*args)
+
+
+posted = []
+
+
+def post(url, json=None, **kwargs):
+    recorder.call('http')
+    posted.append(json)
+
+
+class FakeConnectionPool(object):
+    def __init__(self):
+        self.num_requests = 0
+        self.num_connections = 1
+
+
+class FakePoolManager(object):
+    def __init__(self):
+        self.pools = {}
+
+
+class HTTPAdapter(object):
+    def __init__(self, **kwargs):
+        self.poolmanager = FakePoolManager()
+
+
+class Session(object):
+    """Keep-alive session: only the first request to a host pays for the handshake."""
+
+    def __init__(self):
+        self.adapters = {}
+
+    def mount(self, prefix, adapter):
+        self.adapters[prefix] = adapter
+
+    def post(self, url, json=None, **kwargs):
+        pools = self.adapters['https://'].poolmanager.pools
+        host = url.split('/')[2]
+        if host not in pools:
+            recorder.call('http')
+            pools[host] = FakeConnectionPool()
+        pools[host].num_requests += 1
+        recorder.call('http')
+        posted.append(json)
+
+
+def module(name, **attributes):
+    fake = types.ModuleType(name)
+    fake.__dict__.update(attributes)
+    sys.modules[name] = fake
+    return fake
+
+
+def install():
+    module('boto3', client=boto3_client, resource=boto3_resource)
+    module('slacker', Slacker=Slacker, Error=SlackError)
+    module('pymemcache')
+    module('pymemcache.client')
+    module('pymemcache.client.hash', HashClient=HashClient)
+    module('pynamodb')
+    module('pynamodb.attributes', UnicodeAttribute=Attribute, NumberAttribute=Attribute,
+           UTCDateTimeAttribute=Attribute)
+    module('pynamodb.indexes', GlobalSecondaryIndex=GlobalSecondaryIndex, AllProjection=AllProjection)
+    module('pynamodb.models', Model=Model)
+    module('pynamodb.exceptions', PutError=Exception)
+    module('requests', post=post, Session=Session)
+    module('requests.adapters', HTTPAdapter=HTTPAdapter)
+    module('requests.packages')
+    module('requests.packages.urllib3')
+    module('requests.packages.urllib3.util')
+    module('requests.packages.urllib3.util.retry', Retry=lambda **kwargs: None)
+    module('requests.exceptions', HTTPError=HTTPError)
+    module('tabulate', tabulate=lambda table, headers=None, tablefmt=None: '%s rows' % len(table))
+
+
+def encrypt_token(token):
+    return base64.b64encode('kms:' + token)
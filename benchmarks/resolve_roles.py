@@ -0,0 +1,85 @@
+"""Benchmark thaddeus.resolve_roles against the original list based parse.
+
+Usage: python benchmarks/resolve_roles.py [members] [subdivisions] [configs]
+"""
+from __future__ import print_function
+
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'thaddeus'))
+
+from thaddeus import resolve_roles  # noqa: E402
+
+# The original parse is quadratic in members under Python 2, so it is only
+# run on workspaces small enough to finish.
+LEGACY_LIMIT = 20000
+
+Config = namedtuple('Config', ['id', 'arn', 'priority'])
+
+
+def legacy_resolve_roles(division, team_config):
+    # Behaviour of thaddeus.parse before the indexed resolver.
+    def get_config(configs, id):
+        for config in configs:
+            if config.id == id:
+                return config
+
+    configured_ids = [config.id for config in team_config]
+    users = {}
+    for subdivision in division:
+        if subdivision['id'] in configured_ids:
+            config = get_config(team_config, subdivision['id'])
+            for user in subdivision['members']:
+                if user in users.keys():
+                    users[user].append(config)
+                else:
+                    users[user] = [config]
+    return dict((user, min(configs, key=lambda x: x.priority)) for user, configs in users.items())
+
+
+def synthetic_workspace(members, subdivisions, configs, seed=42):
+    rng = random.Random(seed)
+    users = ['U%08d' % i for i in range(members)]
+    division = []
+    for i in range(subdivisions):
+        size = rng.randint(1, max(1, members // 10))
+        division.append({'id': 'C%06d' % i, 'members': rng.sample(users, size)})
+    configured = rng.sample(division, min(configs, subdivisions))
+    team_config = [Config(id=subdivision['id'],
+                          arn='arn:aws:iam::123456789012:role/role-%d' % (i % 5),
+                          priority=rng.randint(1, 10))
+                   for i, subdivision in enumerate(configured)]
+    return division, team_config
+
+
+def timed(function, *args):
+    started = time.time()
+    result = function(*args)
+    return result, time.time() - started
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    subdivisions = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    configs = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    division, team_config = synthetic_workspace(members, subdivisions, configs)
+    print('%s members, %s subdivisions, %s configs' % (members, subdivisions, configs))
+
+    indexed, indexed_time = timed(resolve_roles, division, team_config)
+    print('indexed: %.3fs' % indexed_time)
+    if members > LEGACY_LIMIT:
+        print('legacy:  skipped above %s members' % LEGACY_LIMIT)
+        return
+    legacy, legacy_time = timed(legacy_resolve_roles, division, team_config)
+    print('legacy:  %.3fs' % legacy_time)
+
+    assert dict((u, c.arn) for u, c in indexed.items()) == dict((u, c.arn) for u, c in legacy.items())
+    print('speedup: %.1fx' % (legacy_time / indexed_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,92 @@
 import base64
+import csv
+import json
 import logging
+import os
+import time
+import zlib
+from collections import OrderedDict
+from StringIO import StringIO
 
 import boto3
+from pymemcache.client.hash import HashClient
 from pynamodb.attributes import NumberAttribute, UnicodeAttribute
+from pynamodb.exceptions import PutError
 from pynamodb.indexes import GlobalSecondaryIndex, AllProjection
 from pynamodb.models import Model
-from slacker import Slacker
+from requests.exceptions import HTTPError
+from slacker import Error as SlackError, Slacker
 from tabulate import tabulate
 
+import sessions
+from metrics import Metrics
+
 log = logging.getLogger()
 log.setLevel(logging.INFO)
+metrics = Metrics('eagle')
 
+MEMCACHED_ENDPOINT = 'alfredbot-users.atjtz9.cfg.euw1.cache.amazonaws.com'
+MEMCACHED_PORT = 11211
+MEMCACHED_CONNECT_TIMEOUT = float(os.environ.get('MEMCACHED_CONNECT_TIMEOUT', '1'))
+MEMCACHED_TIMEOUT = float(os.environ.get('MEMCACHED_TIMEOUT', '0.5'))
+MEMCACHED_POOL_SIZE = int(os.environ.get('MEMCACHED_POOL_SIZE', '4'))
 KMS_ALIAS = 'alias/alfredbot-token'
 CONFIG_TABLE_NAME = 'alfredbot-configuration'
 TOKEN_TABLE_NAME = 'alfredbot-token'
 REGION = 'eu-west-1'
-COMMANDS = ['add', 'remove', 'list', 'help']
+TOKEN_TTL = int(os.environ.get('TOKEN_TTL', '900'))
+# Slack errors meaning the cached token is no longer valid.
+TOKEN_ERRORS = ['invalid_auth', 'not_authed', 'token_revoked', 'account_inactive']
+COMMANDS = ['add', 'remove', 'list', 'import', 'export', 'help']
+EXPORT_FORMATS = ['csv', 'json']
+MAPPING_FIELDS = ['type', 'name', 'arn', 'priority']
+# DynamoDB takes at most 25 items per BatchWriteItem. A chunk that fails
+# on throttling is retried whole, which is safe as every write is a put.
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_MAX_RETRIES = 5
+BATCH_WRITE_BACKOFF = 0.5
+# DynamoDB errors a batch write is retried on, anything else is raised at once.
+BATCH_WRITE_RETRY_ERRORS = ['ProvisionedThroughputExceededException', 'ThrottlingException',
+                            'RequestLimitExceeded']
+DIRECTORY_KEY = '%s_directory_%s'
+DIRECTORY_TTL = int(os.environ.get('DIRECTORY_TTL', '3600'))
+# Slack listing method and response key per mapping type.
+DIRECTORY_METHODS = {'group': ('groups.list', 'groups'),
+                     'channel': ('channels.list', 'channels'),
+                     'usergroup': ('usergroups.list', 'usergroups')}
+# Admins and owners of a team, written by Thaddeus during sync.
+ADMINS_KEY = '%s_admins'
+# Read by the Thaddeus scheduler to sync teams with fresh mapping changes first.
+CONFIG_CHANGED_KEY = '%s_config_changed'
+SLACK_PAGE_SIZE = 200
+SLACK_MAX_RETRIES = 5
+
+
+_memcache_client = None
+
+
+def get_memcache_client():
+    # One pooled client per container, reused by every warm invocation.
+    global _memcache_client
+    if _memcache_client is None:
+        _memcache_client = HashClient([
+            (MEMCACHED_ENDPOINT, MEMCACHED_PORT)
+        ], connect_timeout=MEMCACHED_CONNECT_TIMEOUT,
+           timeout=MEMCACHED_TIMEOUT,
+           use_pooling=True,
+           max_pool_size=MEMCACHED_POOL_SIZE)
+    return _memcache_client
+
+
+class MemCacheHelper(object):
+    def __init__(self):
+        self.client = get_memcache_client()
+
+    def set(self, key, value, expire=0):
+        self.client.set(key, value, expire=expire)
+
+    def get(self, key):
+        return self.client.get(key)
 
 
 class ViewIndex(GlobalSecondaryIndex):
@@ -55,39 +126,86 @@ class SlackHelper(object):
     supported_types = ['group', 'channel', 'usergroup']
 
     def __init__(self, team_id):
-        token = get_token(team_id)
-        self.slack = Slacker(token)
+        self._slack = None
         self.commands = {'group': self.get_group,
                          'channel': self.get_channel,
                          'usergroup': self.get_usergroup}
         self.team_id = team_id
 
+    @property
+    def slack(self):
+        # Built on first use, admin checks and cached lookups never need the token.
+        if self._slack is None:
+            self._slack = Slacker(get_token(self.team_id), session=sessions.get_session())
+        return self._slack
+
     def get_group(self, name):
-        groups = self.slack.groups.list().body['groups']
-        matches = [g for g in groups if g['name'] == name]
-        if matches:
-            return matches[0]['id']
-        else:
-            return False
+        return self.lookup('group', name)
 
     def get_channel(self, name):
-        channel = self.slack.channels.list().body['channels']
-        matches = [cn for cn in channel if cn['name'] == name]
-        if matches:
-            return matches[0]['id']
-        else:
-            return False
+        return self.lookup('channel', name)
 
     def get_usergroup(self, name):
-        usergroups = self.slack.usergroups.list().body['usergroups']
-        matches = [ug for ug in usergroups if ug['name'] == name]
-        if matches:
-            return matches[0]['id']
+        return self.lookup('usergroup', name)
+
+    def build_directory(self, mapping_type):
+        method, key = DIRECTORY_METHODS[mapping_type]
+        if mapping_type == 'usergroup':
+            items = slack_call(self.slack, method)[key]
         else:
-            return False
+            items = paginate(self.slack, method, key, exclude_members=True)
+        directory = dict((item['name'], item['id']) for item in items)
+        try:
+            with metrics.span('memcached_write'):
+                MemCacheHelper().set(DIRECTORY_KEY % (self.team_id, mapping_type),
+                                     zlib.compress(json.dumps(directory)),
+                                     expire=DIRECTORY_TTL)
+        except Exception as e:
+            log.exception(e)
+        log.info('Indexed %s %ss for team %s' % (len(directory), mapping_type, self.team_id))
+        return directory
+
+    def cached_directory(self, mapping_type):
+        # Name -> id index shared by all Eagle containers through memcached.
+        try:
+            with metrics.span('memcached_read'):
+                raw = MemCacheHelper().get(DIRECTORY_KEY % (self.team_id, mapping_type))
+        except Exception as e:
+            log.exception(e)
+            raw = None
+        return json.loads(zlib.decompress(raw)) if raw is not None else {}
+
+    def lookup(self, mapping_type, name):
+        return self.lookup_many(mapping_type, [name]).get(name, False)
+
+    def lookup_many(self, mapping_type, names):
+        directory = self.cached_directory(mapping_type)
+        if all(name in directory for name in names):
+            metrics.count('directory_hit')
+        else:
+            metrics.count('directory_miss')
+            # Missing index or unknown names, which may have been created or renamed since the index was built.
+            directory = self.build_directory(mapping_type)
+        return dict((name, directory[name]) for name in names if name in directory)
+
+    def cached_admins(self):
+        try:
+            with metrics.span('memcached_read'):
+                raw = MemCacheHelper().get(ADMINS_KEY % self.team_id)
+        except Exception as e:
+            log.exception(e)
+            raw = None
+        return set(json.loads(zlib.decompress(raw))['admins']) if raw is not None else set()
 
     def is_admin(self, user_id):
-        user_info = self.slack.users.info(user_id).body
+        if user_id in self.cached_admins():
+            metrics.count('admins_hit')
+            return True
+        # Missing set or someone promoted since it was built, both confirmed live.
+        metrics.count('admins_miss')
+        metrics.count('slack_calls')
+        with metrics.span('slack'):
+            user_info = self.slack.users.info(user_id).body
         return user_info['user']['is_admin']
 
     def get_id(self, mapping_type, type_name):
@@ -98,16 +216,92 @@ class SlackHelper(object):
             return False, 'No %s with name %s' % (mapping_type, type_name)
 
 
+def slack_call(slack, method, **params):
+    # Slack answers 429 with a Retry-After header once a method's rate limit tier is exhausted.
+    for attempt in range(SLACK_MAX_RETRIES):
+        try:
+            metrics.count('slack_calls')
+            with metrics.span('slack'):
+                return slack.api.get(method, params=params).body
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 429 or attempt == SLACK_MAX_RETRIES - 1:
+                raise
+            delay = float(e.response.headers.get('Retry-After', 2 ** attempt))
+            log.info('Rate limited on %s, retrying in %ss' % (method, delay))
+            metrics.count('slack_rate_limited')
+            time.sleep(delay)
+
+
+def paginate(slack, method, key, **params):
+    items = []
+    while True:
+        body = slack_call(slack, method, limit=SLACK_PAGE_SIZE, **params)
+        items.extend(body[key])
+        cursor = body.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return items
+        params['cursor'] = cursor
+
+
+class TokenCache(object):
+    """Decrypted slack tokens kept in memory across warm invocations."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.tokens = {}
+
+    def get(self, team_id):
+        cached = self.tokens.get(team_id)
+        if cached and cached['expires'] > time.time():
+            metrics.count('token_cache_hit')
+            log.info('Token cache hit for team %s, saved a DynamoDB get and a KMS decrypt (~%.3fs)'
+                     % (team_id, cached['cost']))
+            return cached['token']
+
+        metrics.count('token_cache_miss')
+        started = time.time()
+        try:
+            with metrics.span('dynamodb_get_token'):
+                team = TeamModel.get(team_id)
+        except TeamModel.DoesNotExist:
+            return None
+        with metrics.span('kms_decrypt'):
+            token = decrypt(team.token)
+        cost = time.time() - started
+        log.info('Token cache miss for team %s, fetched in %.3fs' % (team_id, cost))
+        self.tokens[team_id] = {'token': token, 'expires': time.time() + self.ttl, 'cost': cost}
+        return token
+
+    def invalidate(self, team_id):
+        self.tokens.pop(team_id, None)
+
+
+_kms_client = None
+
+
+def get_kms_client():
+    global _kms_client
+    if _kms_client is None:
+        _kms_client = boto3.client('kms')
+    return _kms_client
+
+
 def decrypt(cipher_text):
-    kms = boto3.client('kms')
-    res = kms.decrypt(CiphertextBlob=base64.b64decode(cipher_text))
+    res = get_kms_client().decrypt(CiphertextBlob=base64.b64decode(cipher_text))
     return res.get('Plaintext')
 
 
+token_cache = TokenCache(TOKEN_TTL)
+
+
 def get_token(team_id):
-    for team in TeamModel.query(team_id):
-        token = decrypt(team.token)
-        return token
+    return token_cache.get(team_id)
+
+
+def invalidate_token(team_id, error):
+    if str(error) in TOKEN_ERRORS:
+        log.info('Dropping cached token for team %s: %s' % (team_id, error))
+        token_cache.invalidate(team_id)
 
 
 def save_mapping(team_id, type, friendly_name, type_id, arn, priority):
@@ -117,13 +311,25 @@ def save_mapping(team_id, type, friendly_name, type_id, arn, priority):
                                   type=type,
                                   arn=arn,
                                   priority=priority)
-    team_config.save()
+    with metrics.span('dynamodb_write'):
+        team_config.save()
+    mark_config_changed(team_id)
 
 
 def delete_mapping(team_id, type_id):
-    team_configs = TeamConfigModel.query(type_id, team_id__eq=team_id)
-    for team_config in team_configs:
-        team_config.delete()
+    with metrics.span('dynamodb_write'):
+        team_configs = TeamConfigModel.query(type_id, team_id__eq=team_id)
+        for team_config in team_configs:
+            team_config.delete()
+    mark_config_changed(team_id)
+
+
+def mark_config_changed(team_id):
+    # The mapping itself is already saved, so failing to flag it only delays the next sync.
+    try:
+        MemCacheHelper().set(CONFIG_CHANGED_KEY % team_id, str(time.time()))
+    except Exception as e:
+        log.exception(e)
 
 def add_mapping(sh, args):
     if len(args) != 4:
@@ -157,11 +363,117 @@ def remove_mapping(sh, args):
     return True, None
 
 
+def parse_mappings(text):
+    """Reads mappings from a JSON list of objects or CSV rows, both with MAPPING_FIELDS.
+
+    Returns the mappings and a list of errors, one per rejected row.
+    """
+    text = text.strip().strip('`').strip()
+    if text.startswith('['):
+        try:
+            rows = [[unicode(item.get(field, '')) for field in MAPPING_FIELDS] for item in json.loads(text)]
+        except (ValueError, AttributeError) as e:
+            return [], ['Invalid JSON: %s' % e]
+    else:
+        rows = [[value.decode('utf-8').strip() for value in row] for row in csv.reader(StringIO(text.encode('utf-8'))) if row]
+        if rows and [value.lower() for value in rows[0]] == MAPPING_FIELDS:
+            rows = rows[1:]
+    mappings, errors, seen = [], [], {}
+    for number, row in enumerate(rows, 1):
+        if len(row) != len(MAPPING_FIELDS):
+            errors.append('Row %s: expected %s fields' % (number, len(MAPPING_FIELDS)))
+            continue
+        mapping = dict(zip(MAPPING_FIELDS, row))
+        if mapping['type'] not in SlackHelper.supported_types:
+            errors.append('Row %s: unsupported mapping type %s' % (number, mapping['type']))
+        elif not mapping['priority'].isdigit():
+            errors.append('Row %s: priority %s is not a number' % (number, mapping['priority']))
+        elif (mapping['type'], mapping['name']) in seen:
+            errors.append('Row %s: %s %s is already mapped in row %s'
+                          % (number, mapping['type'], mapping['name'], seen[(mapping['type'], mapping['name'])]))
+        else:
+            seen[(mapping['type'], mapping['name'])] = number
+            mapping['priority'] = int(mapping['priority'])
+            mappings.append(mapping)
+    return mappings, errors
+
+
+def is_throttled(error):
+    cause = getattr(error, 'cause', None)
+    if cause is None:
+        # Raised by pynamodb itself when items are still unprocessed after its own retries.
+        return 'max_retries_exceeded' in str(error)
+    return getattr(cause, 'response', {}).get('Error', {}).get('Code') in BATCH_WRITE_RETRY_ERRORS
+
+
+def write_mappings(team_configs):
+    for start in range(0, len(team_configs), BATCH_WRITE_SIZE):
+        chunk = team_configs[start:start + BATCH_WRITE_SIZE]
+        for attempt in range(BATCH_WRITE_MAX_RETRIES):
+            try:
+                with metrics.span('dynamodb_write'):
+                    with TeamConfigModel.batch_write() as batch:
+                        for team_config in chunk:
+                            batch.save(team_config)
+                break
+            except PutError as e:
+                if not is_throttled(e) or attempt == BATCH_WRITE_MAX_RETRIES - 1:
+                    raise
+                delay = BATCH_WRITE_BACKOFF * 2 ** attempt
+                log.info('Batch write throttled (%s), retrying in %ss' % (e, delay))
+                metrics.count('dynamodb_throttled')
+                time.sleep(delay)
+
+
+def import_mappings(sh, text):
+    mappings, errors = parse_mappings(text)
+    if not mappings and not errors:
+        return False, 'Nothing to import, see `/alfred-admin help` for the format'
+    # One directory read per type for all rows, instead of one per mapping.
+    ids = {}
+    for mapping_type in set(mapping['type'] for mapping in mappings):
+        ids[mapping_type] = sh.lookup_many(mapping_type, [mapping['name'] for mapping in mappings
+                                                          if mapping['type'] == mapping_type])
+    for mapping in mappings:
+        if mapping['name'] not in ids[mapping['type']]:
+            errors.append('No %s with name %s' % (mapping['type'], mapping['name']))
+    if errors:
+        # Nothing is written unless every row is valid.
+        return False, 'Nothing imported:\n' + '\n'.join(errors)
+    write_mappings([TeamConfigModel(id=ids[mapping['type']][mapping['name']],
+                                    friendly_name=mapping['name'],
+                                    team_id=sh.team_id,
+                                    type=mapping['type'],
+                                    arn=mapping['arn'],
+                                    priority=mapping['priority']) for mapping in mappings])
+    mark_config_changed(sh.team_id)
+    log.info('Imported %s mappings for team %s' % (len(mappings), sh.team_id))
+    return True, None
+
+
+def export_mappings(team_id, export_format):
+    if export_format not in EXPORT_FORMATS:
+        return 'Unsupported export format %s\n Accepted values: %s' % (export_format, ' '.join(EXPORT_FORMATS))
+    with metrics.span('dynamodb_read'):
+        rows = [[config.type, config.friendly_name, config.arn, int(config.priority)]
+                for config in TeamConfigModel.team_id_index.query(team_id)]
+    if export_format == 'json':
+        # One mapping per line, so the export reads and diffs like the CSV one.
+        exported = '[\n%s\n]' % ',\n'.join(json.dumps(OrderedDict(zip(MAPPING_FIELDS, row))) for row in rows)
+    else:
+        out = StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(MAPPING_FIELDS)
+        writer.writerows([[unicode(value).encode('utf-8') for value in row] for row in rows])
+        exported = out.getvalue()
+    return '```%s```' % exported
+
+
 def list_mapping(team_id):
-    configs = TeamConfigModel.team_id_index.query(team_id)
     table = []
-    for config in configs:
-        table.append([config.type, config.friendly_name, config.arn, config.priority])
+    with metrics.span('dynamodb_read'):
+        for config in TeamConfigModel.team_id_index.query(team_id):
+            table.append([config.type, config.friendly_name, config.arn, config.priority])
     tabulated_format = tabulate(table,
                                 headers=['Type', 'Friendly Name', 'Arn', 'Priority'],
                                 tablefmt='simple')
@@ -180,11 +492,17 @@ def bot_help():
     h += "\nExample: /alfred-admin remove channel general"
     h += "\n`/alfred-admin list`"
     h += "\nReturns list of existing role mappings."
+    h += "\n`/alfred-admin export [csv|json]`"
+    h += "\nReturns all role mappings as CSV (the default) or JSON, with fields `{0}`.".format(','.join(MAPPING_FIELDS))
+    h += "\n`/alfred-admin import <mappings>`"
+    h += "\nAdds or replaces all given role mappings, pasted in the export format."
+    h += "\nExample: /alfred-admin import channel,general,arn:aws:iam::account_number:role/readonly,2"
     h += "\n For more details see www.alfredbot.io/"
     return h
 
 
 def handler(event, context):
+    metrics.start()
     try:
         log.info(event)
         raw_text = event['text']
@@ -200,6 +518,8 @@ def handler(event, context):
         elif args[0] == 'list':
             message = list_mapping(team_id)
             log.info(message)
+        elif args[0] == 'export':
+            message = export_mappings(team_id, args[1] if len(args) > 1 else 'csv')
         else:
             sh = SlackHelper(team_id)
             if sh.is_admin(user_id):
@@ -217,12 +537,25 @@ def handler(event, context):
                         log.info(message)
                     else:
                         log.error(message)
+                elif args[0] == 'import':
+                    status, message = import_mappings(sh, raw_text.split(None, 1)[1] if len(args) > 1 else '')
+                    if status:
+                        message = list_mapping(team_id)
+                        log.info(message)
+                    else:
+                        log.error(message)
             else:
                 message = 'User %s is not an admin' % event['user_name']
                 log.info(message)
+    except SlackError as e:
+        log.exception(e)
+        invalidate_token(event['team_id'], e)
+        message = e.message
     except Exception as e:
         log.exception(e)
         message = e.message
+    sessions.report(metrics)
+    metrics.emit()
     return {
         "response_type": "in_channel",
         'text': message
@@ -0,0 +1,65 @@
+"""Per invocation timing spans and counters.
+
+Call `start()` at the top of a handler, wrap external calls and stages in
+`span(name)`, bump counters with `count(name)` and call `emit()` on the way
+out. `emit()` prints a single CloudWatch Embedded Metric Format line, so the
+numbers become CloudWatch metrics without any extra API call. Extra keyword
+arguments to `Metrics` become additional dimensions, e.g. `Team=team_id`.
+"""
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = 'Alfredbot'
+
+
+class Metrics(object):
+    def __init__(self, function, **dimensions):
+        self.function = function
+        self.dimensions = dimensions
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        self.started = time.time()
+        self.timings = {}
+        self.counters = {}
+
+    @contextmanager
+    def span(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = (time.time() - started) * 1000
+            with self.lock:
+                self.timings[name] = self.timings.get(name, 0) + elapsed
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def emit(self):
+        self.timings['total'] = (time.time() - self.started) * 1000
+        definitions = [{'Name': name, 'Unit': 'Milliseconds'} for name in sorted(self.timings)]
+        definitions += [{'Name': name, 'Unit': unit(name)} for name in sorted(self.counters)]
+        line = {'_aws': {'Timestamp': int(time.time() * 1000),
+                         'CloudWatchMetrics': [{'Namespace': NAMESPACE,
+                                                'Dimensions': [['Function'] + sorted(self.dimensions)],
+                                                'Metrics': definitions}]},
+                'Function': self.function}
+        line.update(self.dimensions)
+        line.update((name, round(value, 2)) for name, value in self.timings.items())
+        line.update(self.counters)
+        sys.stdout.write(json.dumps(line) + '\n')
+        sys.stdout.flush()
+
+
+def unit(name):
+    if name.endswith('_bytes'):
+        return 'Bytes'
+    if name.endswith('_seconds'):
+        return 'Seconds'
+    return 'Count'
@@ -1,30 +1,81 @@
+from __future__ import print_function
+
+import hashlib
+import json
+import os
 import sys
+import threading
 import time
 import botocore
 import boto3
+from Queue import Queue
 from subprocess import Popen, PIPE
 
+# Point at a local CloudFormation stand-in (e.g. `moto_server cloudformation`) to try a deploy offline.
+CLOUDFORMATION_ENDPOINT_URL = os.environ.get('CLOUDFORMATION_ENDPOINT_URL')
+LAMBKIN = os.environ.get('LAMBKIN', 'lambkin')
+# Fingerprints of the last published package of every function, see build_lambda.
+BUILD_CACHE_PATH = os.environ.get('BUILD_CACHE_PATH', '.build-cache.json')
+# Requirements are unpinned, so set this to pick up new releases of unchanged requirements.
+FORCE_REBUILD = os.environ.get('FORCE_REBUILD', 'false').lower() == 'true'
+BUILD_IGNORE_DIRS = ['venv', 'build', 'dist']
+BUILD_IGNORE_SUFFIXES = ('.pyc', '.zip')
+DEPLOY_CONCURRENCY = int(os.environ.get('DEPLOY_CONCURRENCY', '4'))
+# Stack polling starts fast, backs off while nothing happens and speeds up again on new events.
+POLL_MIN_INTERVAL = 2
+POLL_MAX_INTERVAL = 30
+POLL_BACKOFF = 1.5
+
+TRANSITION_STATES = ['CREATE_IN_PROGRESS', 'ROLLBACK_IN_PROGRESS', 'DELETE_IN_PROGRESS', 'UPDATE_IN_PROGRESS',
+                     'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_IN_PROGRESS',
+                     'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS']
+COMPLETED_STATES = ['CREATE_COMPLETE', 'DELETE_COMPLETE', 'UPDATE_COMPLETE']
+
+print_lock = threading.Lock()
+build_cache_lock = threading.Lock()
+
+
+def say(step, message):
+    with print_lock:
+        print('[%s] %s' % (step, message))
+        sys.stdout.flush()
+
+
+def latest_event_id(cf_client, stack_name):
+    try:
+        events = cf_client.describe_stack_events(StackName=stack_name)['StackEvents']
+    except botocore.exceptions.ClientError:
+        return None
+    return events[0]['EventId'] if events else None
+
+
+def new_stack_events(cf_client, stack_name, last_event_id):
+    # Events come newest first, so paging stops at the last one already shown.
+    events = []
+    for page in cf_client.get_paginator('describe_stack_events').paginate(StackName=stack_name):
+        for event in page['StackEvents']:
+            if event['EventId'] == last_event_id:
+                return list(reversed(events))
+            events.append(event)
+    return list(reversed(events))
+
 
-def get_stack_output(cf_client, stack_name):
-    transition_state = ['CREATE_IN_PROGRESS', 'ROLLBACK_IN_PROGRESS', 'DELETE_IN_PROGRESS', 'UPDATE_IN_PROGRESS',
-                        'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_IN_PROGRESS',
-                        'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS']
-    completed_state = ['CREATE_COMPLETE', 'DELETE_COMPLETE', 'UPDATE_COMPLETE']
-    stack_state = 'CREATE_IN_PROGRESS'
-    response = {}
+def get_stack_output(cf_client, stack_name, last_event_id=None):
+    interval = POLL_MIN_INTERVAL
     while True:
         response = cf_client.describe_stacks(StackName=stack_name)
         stack_state = str(response['Stacks'][0]['StackStatus'])
-
-        if stack_state in transition_state:
-            print('Stack: ' + stack_name + ' is in transition: ' + stack_state)
-            print('Waiting 30 seconds...')
-            time.sleep(30)
-            print(stack_state)
-        else:
+        events = new_stack_events(cf_client, stack_name, last_event_id)
+        for event in events:
+            say(stack_name, '%s %s %s' % (event['LogicalResourceId'], event['ResourceStatus'],
+                                          event.get('ResourceStatusReason', '')))
+            last_event_id = event['EventId']
+        if stack_state not in TRANSITION_STATES:
             break
+        interval = POLL_MIN_INTERVAL if events else min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+        time.sleep(interval)
 
-    if stack_state in completed_state:
+    if stack_state in COMPLETED_STATES:
         outputs = {}
         output_list = response['Stacks'][0].get('Outputs', [])
         for output in output_list:
@@ -53,7 +104,7 @@ def create_or_update_stack(cf_client, update, stack_name, template, parameters):
                                    Capabilities=['CAPABILITY_IAM'])
         except botocore.exceptions.ClientError as e:
             if 'No updates are to be performed' in e.message:
-                print 'No updates required for stack: ' + stack_name
+                say(stack_name, 'No updates required')
             else:
                 raise e
 
@@ -67,40 +118,191 @@ def read_stack_file(path):
         return template_file.read()
 
 
-def install_lambda(role_name, lambda_function_name):
+def run_lambkin(lambda_function_name, command):
+    p = Popen("cd %s ; %s %s" % (lambda_function_name, LAMBKIN, command), stdout=PIPE, stderr=PIPE, shell=True)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError('%s %s failed for %s:\n%s%s' % (LAMBKIN, command.split()[0], lambda_function_name,
+                                                          stdout, stderr))
+
+
+def fingerprint(lambda_function_name):
+    """Hashes of the function's requirements and of every other file that goes into its package."""
+    if not os.path.isdir(lambda_function_name):
+        raise RuntimeError('No function directory %s' % os.path.abspath(lambda_function_name))
+    requirements, sources = hashlib.sha256(), hashlib.sha256()
+    for root, dirs, files in os.walk(lambda_function_name):
+        # Virtualenvs and build output of lambkin itself are not sources.
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.') and name not in BUILD_IGNORE_DIRS)
+        for name in sorted(files):
+            if name.endswith(BUILD_IGNORE_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            digest = requirements if path == os.path.join(lambda_function_name, 'requirements.txt') else sources
+            with open(path, 'rb') as source:
+                digest.update(path + '\0' + source.read() + '\0')
+    return {'requirements': requirements.hexdigest(), 'sources': sources.hexdigest()}
+
+
+def read_build_cache():
+    try:
+        with open(BUILD_CACHE_PATH) as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def record_build(lambda_function_name, entry):
+    with build_cache_lock:
+        cache = read_build_cache()
+        cache[lambda_function_name] = entry
+        with open(BUILD_CACHE_PATH, 'w') as cache_file:
+            json.dump(cache, cache_file, indent=2, sort_keys=True, separators=(',', ': '))
+
+
+def build_lambda(lambda_function_name):
+    """Builds the function package unless it is unchanged since its last publish.
+
+    Only a change to requirements.txt makes lambkin reinstall dependencies, its
+    virtualenv is left in place between builds and reused otherwise.
+    """
+    current = fingerprint(lambda_function_name)
+    previous = read_build_cache().get(lambda_function_name, {})
+    unchanged = not FORCE_REBUILD and all(previous.get(key) == value for key, value in current.items())
+    if unchanged:
+        say(lambda_function_name, 'Unchanged since last publish, skipping build')
+    else:
+        if previous.get('requirements') and previous['requirements'] != current['requirements']:
+            say(lambda_function_name, 'Requirements changed, dependencies will be reinstalled')
+        run_lambkin(lambda_function_name, 'build')
+    return {'fingerprint': current, 'unchanged': unchanged}
+
+
+def install_lambda(role_name, lambda_function_name, build=None):
     if not role_name:
-        print 'Lambda role already installed, skipping'
+        say(lambda_function_name, 'Lambda role already installed, skipping')
         return
 
-    try:
-        p = Popen("cd %s ; lambkin build ; lambkin publish --description 'Serverless demo bot' --role %s"
-                  % (lambda_function_name, role_name),
-                  stdout=PIPE, stderr=PIPE, shell=True)
-        stdout, stderr = p.communicate()
+    if build and build['unchanged'] and read_build_cache()[lambda_function_name].get('role') == role_name:
+        say(lambda_function_name, 'Unchanged since last publish, skipping publish')
         return lambda_function_name
-
-    except Exception as e:
-        print stdout
-        print stderr
-        print "Exception, while installing lambda: " + e.message
+    run_lambkin(lambda_function_name, "publish --description 'Serverless demo bot' --role %s" % role_name)
+    if build:
+        record_build(lambda_function_name, dict(build['fingerprint'], role=role_name))
+    return lambda_function_name
 
 
 def install_stack(cf_client, stack_name, template_path, parameters=[]):
     update = cf_stack_exists(cf_client, stack_name)
+    last_event_id = latest_event_id(cf_client, stack_name) if update else None
     template = read_stack_file(template_path)
     create_or_update_stack(cf_client, update, stack_name, template, parameters)
 
-    outputs = get_stack_output(cf_client, stack_name)
+    outputs = get_stack_output(cf_client, stack_name, last_event_id)
 
-    if outputs:
+    if outputs is not None:
         return outputs
     else:
-        print("Stack {} has either FAILED or has no outputs, so I am unable to proceed.".format(stack_name))
+        raise RuntimeError("Stack {} has either FAILED or has no outputs, so I am unable to proceed.".format(stack_name))
+
+
+class Step(object):
+    """One node of the deploy graph, run once every step it requires has succeeded.
+
+    `run` gets the results of the required steps, in the order they are listed.
+    """
+
+    def __init__(self, name, run, requires=()):
+        self.name = name
+        self.run = run
+        self.requires = list(requires)
+
+
+def run_steps(steps, concurrency=DEPLOY_CONCURRENCY):
+    """Runs steps as soon as their requirements are met, at most `concurrency` at a time."""
+    pending = dict((step.name, step) for step in steps)
+    results, timings, failed = {}, {}, set()
+    finished = Queue()
+    running = 0
+
+    def run(step):
+        started = time.time()
+        try:
+            result, error = step.run(*[results[name] for name in step.requires]), None
+        except Exception as e:
+            result, error = None, e
+        finished.put((step, result, error, time.time() - started))
+
+    while pending or running:
+        for step in sorted(pending.values(), key=lambda step: step.name):
+            if any(name in failed for name in step.requires):
+                say(step.name, 'Skipped, a step it requires failed')
+                failed.add(pending.pop(step.name).name)
+                timings[step.name] = ('skipped', 0)
+            elif running < concurrency and all(name in results for name in step.requires):
+                say(step.name, 'Started')
+                thread = threading.Thread(target=run, args=(pending.pop(step.name),))
+                thread.daemon = True
+                thread.start()
+                running += 1
+        if not running:
+            if any(name in failed for step in pending.values() for name in step.requires):
+                continue
+            if pending:
+                raise RuntimeError('Steps %s require unknown steps' % ', '.join(sorted(pending)))
+            break
+        step, result, error, elapsed = finished.get()
+        running -= 1
+        if error:
+            say(step.name, 'Failed after %.1fs: %s' % (elapsed, error))
+            failed.add(step.name)
+            timings[step.name] = ('failed', elapsed)
+        else:
+            say(step.name, 'Done in %.1fs' % elapsed)
+            results[step.name] = result
+            timings[step.name] = ('done', elapsed)
+    return results, timings
+
+
+def deploy_steps(cf_client, slack_team_id):
+    def stack(name, template_path, parameters=lambda *results: []):
+        return lambda *results: install_stack(cf_client, name, template_path, parameters(*results))
+
+    def lambda_role(role_key, lambda_function_name):
+        return lambda outputs, build: install_lambda(outputs.get(role_key, None), lambda_function_name, build)
+
+    steps = [
+        Step('alfredrole', stack('alfredrole', 'alfred/lambda_role.json')),
+        Step('build alfred', lambda: build_lambda('alfred')),
+        Step('publish alfred', lambda_role('AlfredAssumedRole', 'alfred'), requires=['alfredrole', 'build alfred']),
+        Step('alfred-apigateway', stack('alfred-apigateway', 'deploy/deploy_stack.json', lambda function_name: [
+            {'ParameterKey': 'LambdaFunctionName', 'ParameterValue': function_name, 'UsePreviousValue': False}]),
+            requires=['publish alfred']),
+        Step('alfred-full', stack('alfred-full', 'deploy/deploy_assumed_roles.json', lambda outputs: [
+            {'ParameterKey': 'AlfredAssumedRoleArn', 'ParameterValue': outputs.get('AlfredAssumedRoleArn', None),
+             'UsePreviousValue': False},
+            {'ParameterKey': 'CreateAdminRole', 'ParameterValue': "yes", 'UsePreviousValue': False},
+            {'ParameterKey': 'CreateOpsRole', 'ParameterValue': "yes", 'UsePreviousValue': False},
+            {'ParameterKey': 'CreateReadOnlyRole', 'ParameterValue': "yes", 'UsePreviousValue': False},
+            {'ParameterKey': 'SlackTeamDomain', 'ParameterValue': slack_team_id, 'UsePreviousValue': False}]),
+            requires=['alfredrole']),
+    ]
+    for name in ['eagle', 'outsider', 'thaddeus']:
+        steps += [
+            Step(name, stack(name, '%s/lambda_role.json' % name)),
+            Step('build %s' % name, lambda name=name: build_lambda(name)),
+            Step('publish %s' % name, lambda_role('%sAssumedRole' % name.capitalize(), name),
+                 requires=[name, 'build %s' % name]),
+        ]
+    steps.append(Step('thaddeus-schedule', stack('thaddeus-schedule', 'deploy/schedule_stack.json', lambda _: [
+        {'ParameterKey': 'LambdaFunctionName', 'ParameterValue': 'thaddeus', 'UsePreviousValue': False}]),
+        requires=['publish thaddeus']))
+    return steps
 
 
 def main():
     if len(sys.argv) < 4:
-        print 'Please read README.md for usage instruction.'
+        print('Please read README.md for usage instruction.')
         sys.exit(2)
 
     profile = str(sys.argv[1])
@@ -108,31 +310,17 @@ def main():
     slack_team_id = str(sys.argv[3])
 
     session = boto3.Session(region_name=region, profile_name=profile)
-    cf_client = session.client('cloudformation')
-
-    lambda_role_outputs = install_stack(cf_client, 'alfredrole', 'alfred/lambda_role.json')
-    assumed_role = lambda_role_outputs.get('AlfredAssumedRole', None)
-    assumed_role_arn = lambda_role_outputs.get('AlfredAssumedRoleArn', None)
-    lambda_function_name = install_lambda(assumed_role, 'bot')
-
-    install_stack(cf_client, 'alfred-apigateway', 'deploy/deploy_stack.json', parameters=[
-        {'ParameterKey': 'LambdaFunctionName', 'ParameterValue': lambda_function_name, 'UsePreviousValue': False}])
-
-    install_stack(cf_client, 'alfred-full', 'deploy/deploy_assumed_roles.json', parameters=[
-        {'ParameterKey': 'AlfredAssumedRoleArn', 'ParameterValue': assumed_role_arn, 'UsePreviousValue': False},
-        {'ParameterKey': 'CreateAdminRole', 'ParameterValue': "yes", 'UsePreviousValue': False},
-        {'ParameterKey': 'CreateOpsRole', 'ParameterValue': "yes", 'UsePreviousValue': False},
-        {'ParameterKey': 'CreateReadOnlyRole', 'ParameterValue': "yes", 'UsePreviousValue': False},
-        {'ParameterKey': 'SlackTeamDomain', 'ParameterValue': slack_team_id, 'UsePreviousValue': False}])
-
-    eagle_role_outputs = install_stack(cf_client, 'eagle', 'eagle/lambda_role.json')
-    install_lambda(eagle_role_outputs.get('EagleAssumedRole', None), 'eagle')
+    cf_client = session.client('cloudformation', endpoint_url=CLOUDFORMATION_ENDPOINT_URL)
 
-    outsider_role_outputs = install_stack(cf_client, 'outsider', 'outsider/lambda_role.json')
-    install_lambda(outsider_role_outputs.get('OutsiderAssumedRole', None), 'outsider')
+    started = time.time()
+    _, timings = run_steps(deploy_steps(cf_client, slack_team_id))
 
-    thaddeus_role_outputs = install_stack(cf_client, 'thaddeus', 'thaddeus/lambda_role.json')
-    install_lambda(thaddeus_role_outputs.get('ThaddeusAssumedRole', None), 'thaddeus')
+    print('\n%-20s %-8s %8s' % ('step', 'status', 'seconds'))
+    for name, (status, elapsed) in sorted(timings.items(), key=lambda item: -item[1][1]):
+        print('%-20s %-8s %8.1f' % (name, status, elapsed))
+    print('%-20s %-8s %8.1f' % ('total', '', time.time() - started))
+    if any(status != 'done' for status, _ in timings.values()):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -7,8 +7,12 @@ from pynamodb.models import Model
 from pynamodb.attributes import UnicodeAttribute
 from slacker import Slacker
 
+import sessions
+from metrics import Metrics
+
 log = logging.getLogger()
 log.setLevel(logging.DEBUG)
+metrics = Metrics('outsider')
 
 BUCKET_NAME = 'alfredbot-configuration'
 OBJECT_NAME = 'credentials.json'
@@ -28,31 +32,36 @@ class TeamModel(Model):
 def save_token(team_id, encrypted_token):
     team = TeamModel(team_id=team_id,
                      token=encrypted_token)
-    team.save()
+    with metrics.span('dynamodb_write'):
+        team.save()
 
 def encrypt(token):
     kms = boto3.client('kms')
-    c_text = kms.encrypt(KeyId=KMS_ALIAS, Plaintext=token)
+    with metrics.span('kms_encrypt'):
+        c_text = kms.encrypt(KeyId=KMS_ALIAS, Plaintext=token)
     return base64.b64encode(c_text['CiphertextBlob'])
 
 def load_credentials():
     # TODO(@gdebreczeni): encrypt client id and secret
     s3 = boto3.resource('s3')
     object = s3.Object(BUCKET_NAME, OBJECT_NAME)
-    body = object.get()['Body']
-    credentials = json.loads(body.read())
+    with metrics.span('s3_read'):
+        body = object.get()['Body']
+        credentials = json.loads(body.read())
     return credentials
 
 def authorise(code):
-    slack = Slacker('mock')
+    slack = Slacker('mock', session=sessions.get_session())
     credentials = load_credentials()
-    response = slack.oauth.access(client_id=credentials['client_id'],
-                                  client_secret=credentials['client_secret'],
-                                  code=code)
+    with metrics.span('slack'):
+        response = slack.oauth.access(client_id=credentials['client_id'],
+                                      client_secret=credentials['client_secret'],
+                                      code=code)
     auth_body = response.body
     return auth_body
 
 def handler(event, context):
+    metrics.start()
     try:
         print event
         code = event['params']['querystring']['code']
@@ -65,5 +74,9 @@ def handler(event, context):
     except Exception as e:
         print e
         log.exception(e)
+        metrics.count('install_failed')
         return {'location': 'http://alfredbot.io/error.html'}
+    finally:
+        sessions.report(metrics)
+        metrics.emit()
     return {'location': 'http://alfredbot.io/'}
@@ -0,0 +1,60 @@
+"""Shared keep-alive HTTP session for Slack API calls and response_url posts.
+
+`get_session()` returns one pooled `requests.Session` per container, so warm
+invocations reuse open connections instead of paying a TCP and TLS handshake
+per request. Only failed connects and 502/503/504 answers are retried, and
+POSTs never are, so a message is not posted twice. `report(metrics)` counts
+the requests sent and connections opened since the previous report.
+"""
+import os
+import threading
+
+POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '4'))
+POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '8'))
+TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', '5'))
+MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '2'))
+
+_session = None
+_lock = threading.Lock()
+_reported = {'requests': 0, 'connections': 0}
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            # Imported here so that paths which never make a request do not load requests.
+            import requests
+            from requests.adapters import HTTPAdapter
+            from requests.packages.urllib3.util.retry import Retry
+            retries = Retry(total=MAX_RETRIES, read=0, backoff_factor=0.2,
+                            status_forcelist=[502, 503, 504], raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                                  max_retries=retries)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
+
+
+def connection_stats():
+    sent = opened = 0
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            sent += pool.num_requests
+            opened += pool.num_connections
+    return sent, opened
+
+
+def report(metrics):
+    if _session is None:
+        return
+    with _lock:
+        sent, opened = connection_stats()
+        # Pools evicted since the last report take their counts with them.
+        metrics.count('http_requests', max(0, sent - _reported['requests']))
+        metrics.count('http_connections_opened', max(0, opened - _reported['connections']))
+        _reported.update(requests=sent, connections=opened)
@@ -1,37 +1,130 @@
 from __future__ import print_function
 import base64
+import hashlib
+import hmac
+import json
 import logging
+import os
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
 
 import boto3
 from pymemcache.client.hash import HashClient
 from pynamodb.attributes import NumberAttribute, UnicodeAttribute
 from pynamodb.indexes import GlobalSecondaryIndex, AllProjection
 from pynamodb.models import Model
-from slacker import Slacker
+from requests.exceptions import HTTPError
+from slacker import Error as SlackError, Slacker
+
+import sessions
+from metrics import Metrics
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
+metrics = Metrics('thaddeus')
 
 MEMCACHED_ENDPOINT = 'alfredbot-users.atjtz9.cfg.euw1.cache.amazonaws.com'
 MEMCACHED_PORT = 11211
+MEMCACHED_CONNECT_TIMEOUT = float(os.environ.get('MEMCACHED_CONNECT_TIMEOUT', '1'))
+MEMCACHED_TIMEOUT = float(os.environ.get('MEMCACHED_TIMEOUT', '0.5'))
+MEMCACHED_POOL_SIZE = int(os.environ.get('MEMCACHED_POOL_SIZE', '4'))
 KMS_ALIAS = 'alias/alfredbot-token'
 CONFIG_TABLE_NAME = 'alfredbot-configuration'
 TOKEN_TABLE_NAME = 'alfredbot-token'
 REGION = 'eu-west-1'
+TOKEN_TTL = int(os.environ.get('TOKEN_TTL', '900'))
+CREDENTIALS_BUCKET = 'alfredbot-configuration'
+CREDENTIALS_OBJECT = 'credentials.json'
+# Signed event requests older than this are refused, so a captured one cannot be replayed.
+SLACK_SIGNATURE_MAX_AGE = 300
+# Slack errors meaning the cached token is no longer valid.
+TOKEN_ERRORS = ['invalid_auth', 'not_authed', 'token_revoked', 'account_inactive']
+# Slack errors that only concern one mapping, such as a deleted channel or the bot having
+# been removed from it. Any other error fails the sync instead of emptying the mapping.
+MEMBERSHIP_ERRORS = ['channel_not_found', 'not_in_channel']
+SET_MANY_BATCH_SIZE = int(os.environ.get('SET_MANY_BATCH_SIZE', '500'))
+# Reading the role table back after writing it doubles the round trips,
+# so it is only done when explicitly asked for.
+DEBUG_READBACK = os.environ.get('DEBUG_READBACK', 'false').lower() == 'true'
+# Per team role table. The pointer holds "<generation> <role list digest> <shard digest>..."
+# and the role list and user -> role index shards are stored under keys named by a digest of
+# their content. A sync only writes the keys the current table does not already have and
+# then flips the pointer.
+ROLE_TABLE_KEY = '%s_roles'
+ROLE_LIST_KEY = '%s_roles_list_%s'
+ROLE_SHARD_KEY = '%s_roles_shard_%s'
+ROLE_TABLE_SHARD_USERS = 20000
+# How long readers holding the previous pointer can still read keys the new one dropped.
+ROLE_TABLE_GRACE = 300
+LEGACY_SNAPSHOT_KEY = '%s_snapshot'
+# Written for users that lost every role, matching what Alfred stores for them.
+NO_ROLE = '-'
+# Admins and owners of a team, read by Eagle instead of a users.info call per command.
+ADMINS_KEY = '%s_admins'
+ADMINS_TTL = int(os.environ.get('ADMINS_TTL', '1800'))
+# Refreshed by the scheduled sync, since walking users.list scales with the workspace and sits
+# in a low rate limit tier. /alfred-sync only builds a missing one. A set younger than this
+# is not rebuilt.
+ADMINS_REFRESH_AGE = int(os.environ.get('ADMINS_REFRESH_AGE', '1200'))
+# Events affecting more users than this mark the team for the next scheduled sync instead,
+# so the events request URL always answers well within Slack's three second limit.
+EVENT_MAX_USERS = int(os.environ.get('EVENT_MAX_USERS', '10'))
+# Scheduled sync of every team, see schedule_handler.
+SYNCED_KEY = '%s_synced'
+CONFIG_CHANGED_KEY = '%s_config_changed'
+SCHEDULE_CONCURRENCY = int(os.environ.get('SCHEDULE_CONCURRENCY', '2'))
+# Team syncs start at least this many seconds apart, so Slack sees a steady trickle.
+SCHEDULE_SPACING = float(os.environ.get('SCHEDULE_SPACING', '2'))
+# Unchanged teams synced more recently than this are left for a later run.
+SCHEDULE_MIN_AGE = int(os.environ.get('SCHEDULE_MIN_AGE', '900'))
+SCHEDULE_TIME_RESERVE_MS = 30000
+SLACK_FETCH_CONCURRENCY = int(os.environ.get('SLACK_FETCH_CONCURRENCY', '4'))
+SLACK_PAGE_SIZE = 200
+SLACK_MAX_RETRIES = 5
+
+
+_memcache_client = None
+
+
+def get_memcache_client():
+    # One pooled client per container, reused by every warm invocation.
+    global _memcache_client
+    if _memcache_client is None:
+        _memcache_client = HashClient([
+            (MEMCACHED_ENDPOINT, MEMCACHED_PORT)
+        ], connect_timeout=MEMCACHED_CONNECT_TIMEOUT,
+           timeout=MEMCACHED_TIMEOUT,
+           use_pooling=True,
+           max_pool_size=MEMCACHED_POOL_SIZE)
+    return _memcache_client
 
 
 class MemCacheHelper(object):
     def __init__(self):
-        self.client = HashClient([
-            (MEMCACHED_ENDPOINT, MEMCACHED_PORT)
-        ])
+        self.client = get_memcache_client()
 
-    def set(self, key, value):
-        self.client.set(key, value)
+    def set(self, key, value, expire=0):
+        self.client.set(key, value, expire=expire)
 
     def get(self, key):
         return self.client.get(key)
 
+    def set_many(self, values):
+        return self.client.set_many(values)
+
+    def get_many(self, keys):
+        return self.client.get_many(keys)
+
+    def delete_many(self, keys):
+        return self.client.delete_many(keys)
+
+    def delete(self, key):
+        return self.client.delete(key)
+
+    def touch(self, key, expire):
+        return self.client.touch(key, expire)
+
 
 class ViewIndex(GlobalSecondaryIndex):
     class Meta:
@@ -71,73 +164,568 @@ def get_team_config(team_id):
     return list(team_configs)
 
 
+class TokenCache(object):
+    """Decrypted slack tokens kept in memory across warm invocations."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.tokens = {}
+
+    def get(self, team_id):
+        cached = self.tokens.get(team_id)
+        if cached and cached['expires'] > time.time():
+            metrics.count('token_cache_hit')
+            log.info('Token cache hit for team %s, saved a DynamoDB get and a KMS decrypt (~%.3fs)'
+                     % (team_id, cached['cost']))
+            return cached['token']
+
+        metrics.count('token_cache_miss')
+        started = time.time()
+        try:
+            with metrics.span('dynamodb_get_token'):
+                team = TeamModel.get(team_id)
+        except TeamModel.DoesNotExist:
+            return None
+        with metrics.span('kms_decrypt'):
+            token = decrypt(team.token)
+        cost = time.time() - started
+        log.info('Token cache miss for team %s, fetched in %.3fs' % (team_id, cost))
+        self.tokens[team_id] = {'token': token, 'expires': time.time() + self.ttl, 'cost': cost}
+        return token
+
+    def invalidate(self, team_id):
+        self.tokens.pop(team_id, None)
+
+
+_kms_client = None
+
+
+def get_kms_client():
+    global _kms_client
+    if _kms_client is None:
+        _kms_client = boto3.client('kms')
+    return _kms_client
+
+
 def decrypt(cipher_text):
-    kms = boto3.client('kms')
-    res = kms.decrypt(CiphertextBlob=base64.b64decode(cipher_text))
+    res = get_kms_client().decrypt(CiphertextBlob=base64.b64decode(cipher_text))
     return res.get('Plaintext')
 
 
+token_cache = TokenCache(TOKEN_TTL)
+
+
 def get_token(team_id):
-    for team in TeamModel.query(team_id):
-        token = decrypt(team.token)
-        return token
+    return token_cache.get(team_id)
 
 
-def get_config(configs, id):
-    for config in configs:
-        if config.id == id:
-            return config
+def invalidate_token(team_id, error):
+    if str(error) in TOKEN_ERRORS:
+        log.info('Dropping cached token for team %s: %s' % (team_id, error))
+        token_cache.invalidate(team_id)
 
 
-def add_to_cache(team_id, user, role):
-    # Need to concatenate team_id and user as user is only unique within the team
+def resolve_roles(division, team_config):
+    # Treat channel/group/usergroup as one type because the field structure of interest is the same.
+    # Single pass over all members, keeping the strongest (lowest priority) config seen per user.
+    configs = dict((config.id, config) for config in team_config)
+    users = {}
+    for subdivision in division:
+        config = configs.get(subdivision['id'])
+        if config is None or subdivision['members'] is None:
+            continue
+        for user in subdivision['members']:
+            current = users.get(user)
+            if current is None or config.priority < current.priority:
+                users[user] = config
+    return users
+
+
+def shard_of(user, shards):
+    return (zlib.crc32(user.encode('utf-8')) & 0xffffffff) % shards
+
+
+def pack_shard(users):
+    return zlib.compress('\n'.join('%s %d' % item for item in sorted(users.iteritems())))
+
+
+def unpack_shard(raw):
+    lines = zlib.decompress(raw).split('\n')
+    return dict((user, int(index)) for user, index in (line.split(' ') for line in lines if line))
+
+
+def read_pointer(raw):
+    # Pointers written before shards were content addressed hold "<generation> <shards>",
+    # their table is treated as missing and rewritten by the next sync.
+    if raw is None:
+        return 0, []
+    parts = raw.split()
+    if len(parts) < 3:
+        return int(parts[0]), []
+    return int(parts[0]), parts[1:]
+
+
+def content_digest(value):
+    return hashlib.sha1(value).hexdigest()[:16]
+
+
+def table_keys(team_id, digests):
+    return [ROLE_LIST_KEY % (team_id, digests[0])] + \
+           [ROLE_SHARD_KEY % (team_id, digest) for digest in digests[1:]]
+
+
+def load_table(team_id):
     mc = MemCacheHelper()
-    unique_user_id = '%s_%s' % (team_id, user)
-    mc.set(unique_user_id, role)
-    log.info('Value in memcached for %s is %s' % (unique_user_id, mc.get(unique_user_id)))
+    with metrics.span('memcached_read'):
+        generation, digests = read_pointer(mc.get(ROLE_TABLE_KEY % team_id))
+        if not digests:
+            return generation, [], [], {}
+        keys = table_keys(team_id, digests)
+        values = mc.get_many(keys)
+    if len(values) != len(keys):
+        # Part of the table was evicted, so the next one is written from scratch.
+        log.info('Role table generation %s of team %s is incomplete' % (generation, team_id))
+        return generation, [], [], {}
+    role_list = json.loads(values[keys[0]])
+    roles = {}
+    for key in keys[1:]:
+        for user, index in unpack_shard(values[key]).iteritems():
+            roles[user] = role_list[index]
+    return generation, digests, role_list, roles
+
+
+def save_table(team_id, generation, digests, role_list, roles):
+    mc = MemCacheHelper()
+    # Generations also tag per user overrides and Alfred's in-process roles, so they must
+    # keep increasing even when the pointer itself was evicted.
+    new_generation = max(generation + 1, int(time.time() * 1000))
+    # The shard count and role indexes are kept while they still fit, so a shard whose users
+    # did not change packs to the same bytes and its key is carried over without a write.
+    needed = max(1, -(-len(roles) // ROLE_TABLE_SHARD_USERS))
+    shards = len(digests) - 1
+    if not needed <= shards <= 2 * needed:
+        shards = needed
+    if not set(roles.itervalues()) <= set(role_list):
+        role_list = sorted(set(roles.itervalues()))
+    indexes = dict((role, index) for index, role in enumerate(role_list))
+    packed = [{} for _ in range(shards)]
+    for user, role in roles.iteritems():
+        packed[shard_of(user, shards)][user] = indexes[role]
+
+    blobs = [json.dumps(role_list)] + [pack_shard(users) for users in packed]
+    new_digests = [content_digest(blob) for blob in blobs]
+    keys = table_keys(team_id, new_digests)
+    old_keys = set(table_keys(team_id, digests)) if digests else set()
+    values = dict((key, blob) for key, blob in zip(keys, blobs) if key not in old_keys)
+    written = sum(len(value) for value in values.itervalues())
+    metrics.count('role_table_keys_written', len(values))
+    metrics.count('role_table_bytes', written)
+    if values:
+        with metrics.span('memcached_write'):
+            failed = mc.set_many(values)
+        if failed:
+            raise RuntimeError('Failed to write role table for team %s' % team_id)
+    # Flipping the pointer is the single write that makes the whole new generation visible.
+    with metrics.span('memcached_write'):
+        mc.set(ROLE_TABLE_KEY % team_id, '%d %s' % (new_generation, ' '.join(new_digests)))
+        for key in old_keys - set(keys):
+            mc.touch(key, ROLE_TABLE_GRACE)
+    log.info('Role table generation %s of team %s: %s users, %s roles, %s of %s keys written (%s bytes)'
+             % (new_generation, team_id, len(roles), len(role_list), len(values), len(keys), written))
+    return new_generation, len(values), written
+
+
+def drop_legacy_keys(team_id):
+    # Per user keys written before the role table existed, as listed by their snapshot.
+    mc = MemCacheHelper()
+    raw = mc.get(LEGACY_SNAPSHOT_KEY % team_id)
+    if raw is None:
+        return
+    keys = ['%s_%s' % (team_id, user) for user in json.loads(zlib.decompress(raw))['users']]
+    for start in range(0, len(keys), SET_MANY_BATCH_SIZE):
+        mc.delete_many(keys[start:start + SET_MANY_BATCH_SIZE])
+    mc.delete(LEGACY_SNAPSHOT_KEY % team_id)
+    log.info('Dropped %s legacy role keys for team %s' % (len(keys), team_id))
+
+
+def diff_roles(previous, current):
+    changed = dict((user, role) for user, role in current.iteritems() if previous.get(user) != role)
+    removed = [user for user in previous if user not in current]
+    return changed, removed
+
+
+def keep_previous_members(users, previous, division, team_config):
+    # Mappings whose members could not be fetched keep the users that held their role before.
+    failed = set(subdivision['id'] for subdivision in division if subdivision['members'] is None)
+    configs = [config for config in team_config if config.id in failed]
+    for user, role in previous.iteritems():
+        for config in configs:
+            current = users.get(user)
+            if role == config.arn and (current is None or config.priority < current.priority):
+                users[user] = config
 
 
 def parse(team_id, division, team_config):
-    # Treat channel/group/usergroup as one type because the field structure of interest is the same
-    configured_ids = [config.id for config in team_config]
-    users = {}
-    for subdivision in division:
-        if subdivision['id'] in configured_ids:
-            config = get_config(team_config, subdivision['id'])
-            for user in subdivision['members']:
-                if user in users.keys():
-                    users[user].append(config)
-                else:
-                    users[user] = [config]
+    with metrics.span('resolve_roles'):
+        users = resolve_roles(division, team_config)
+    generation, digests, role_list, previous = load_table(team_id)
+    keep_previous_members(users, previous, division, team_config)
+    roles = dict((user, config.arn) for user, config in users.iteritems())
+    changed, removed = diff_roles(previous, roles)
+    keys_written = bytes_written = 0
+    if changed or removed or not previous:
+        generation, keys_written, bytes_written = save_table(team_id, generation, digests, role_list, roles)
+        if DEBUG_READBACK:
+            log.info('Read back %s mappings for team %s' % (len(load_table(team_id)[3]), team_id))
+    drop_legacy_keys(team_id)
+    metrics.count('mappings_written', len(changed))
+    metrics.count('mappings_removed', len(removed))
+    metrics.count('mappings_skipped', len(roles) - len(changed))
+    return {'written': len(changed),
+            'removed': len(removed),
+            'skipped': len(roles) - len(changed),
+            'keys_written': keys_written,
+            'bytes_written': bytes_written,
+            'generation': generation}
+
+
+def slack_call(slack, method, **params):
+    # Slack answers 429 with a Retry-After header once a method's rate limit tier is exhausted.
+    for attempt in range(SLACK_MAX_RETRIES):
+        try:
+            metrics.count('slack_calls')
+            with metrics.span('slack'):
+                return slack.api.get(method, params=params).body
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 429 or attempt == SLACK_MAX_RETRIES - 1:
+                raise
+            delay = float(e.response.headers.get('Retry-After', 2 ** attempt))
+            log.info('Rate limited on %s, retrying in %ss' % (method, delay))
+            metrics.count('slack_rate_limited')
+            time.sleep(delay)
+
+
+def paginate(slack, method, key, **params):
+    items = []
+    while True:
+        body = slack_call(slack, method, limit=SLACK_PAGE_SIZE, **params)
+        items.extend(body[key])
+        cursor = body.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return items
+        params['cursor'] = cursor
+
+
+def fetch_members(slack, config):
+    try:
+        if config.type == 'usergroup':
+            members = slack_call(slack, 'usergroups.users.list', usergroup=config.id)['users']
+        else:
+            members = paginate(slack, 'conversations.members', 'members', channel=config.id)
+    except SlackError as e:
+        if str(e) not in MEMBERSHIP_ERRORS:
+            raise
+        log.error('Could not fetch members of %s %s, keeping its previous members: %s'
+                  % (config.type, config.friendly_name, e))
+        metrics.count('mappings_fetch_failed')
+        members = None
+    return {'id': config.id, 'members': members}
+
+
+_fetch_pool = None
+
+
+def get_fetch_pool():
+    # Kept for the life of the container: closing a ThreadPool waits on its 0.1s polling loop.
+    global _fetch_pool
+    if _fetch_pool is None:
+        _fetch_pool = ThreadPool(SLACK_FETCH_CONCURRENCY)
+    return _fetch_pool
+
 
-    for user, configs in users.iteritems():
-        # Find out which role weights the most.
-        # In case user belongs to several channels with different roles, we want the strongest one.
-        config = min(configs, key=lambda x: x.priority)
-        add_to_cache(team_id, user, config.arn)
+def fetch_division(slack, team_config):
+    # Only the configured channels/groups/usergroups are fetched, so the cost of a sync
+    # follows the number of mappings instead of the size of the workspace.
+    return get_fetch_pool().map(lambda config: fetch_members(slack, config), team_config)
+
+
+def record_sync(team_id):
+    MemCacheHelper().set(SYNCED_KEY % team_id, str(time.time()))
+
+
+def refresh_admins(team_id, context, only_missing=False):
+    mc = MemCacheHelper()
+    raw = mc.get(ADMINS_KEY % team_id)
+    if raw is not None and (only_missing or
+                            time.time() - json.loads(zlib.decompress(raw))['built'] < ADMINS_REFRESH_AGE):
+        return
+    slack = Slacker(get_token(team_id), session=sessions.get_session())
+    members, params = [], {}
+    with metrics.span('refresh_admins'):
+        while True:
+            if context and context.get_remaining_time_in_millis() < SCHEDULE_TIME_RESERVE_MS:
+                # A partial walk would drop admins, so the set is left to the next run.
+                log.info('Out of time listing users of team %s, admins not refreshed' % team_id)
+                metrics.count('admins_deferred')
+                return
+            body = slack_call(slack, 'users.list', limit=SLACK_PAGE_SIZE, **params)
+            members.extend(body['members'])
+            cursor = body.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+            params['cursor'] = cursor
+    admins = [member['id'] for member in members
+              if not member.get('deleted') and (member.get('is_admin') or member.get('is_owner'))]
+    mc.set(ADMINS_KEY % team_id, zlib.compress(json.dumps({'built': time.time(), 'admins': admins})),
+           expire=ADMINS_TTL)
+    log.info('Stored %s admins of %s members for team %s' % (len(admins), len(members), team_id))
 
 
 def update_role_mapping(team_id):
     token = get_token(team_id)
-    slack = Slacker(token)
-    groups = slack.groups.list().body['groups']
-    channels = slack.channels.list().body['channels']
-    usergroups = slack.usergroups.list().body['usergroups']
-    division = groups + channels + usergroups
-    team_config = get_team_config(team_id)
-    parse(team_id, division, team_config)
+    slack = Slacker(token, session=sessions.get_session())
+    with metrics.span('dynamodb_team_config'):
+        team_config = get_team_config(team_id)
+    with metrics.span('fetch_division'):
+        division = fetch_division(slack, team_config)
+    return parse(team_id, division, team_config)
 
 
 def handler(event, context):
+    if event.get('source') == 'aws.events':
+        # The schedule rule of deploy/schedule_stack.json invokes the function published by lambkin.
+        return schedule_handler(event, context)
+    metrics.start()
     try:
         log.debug(event)
         team_id = event['team_id']
-        update_role_mapping(team_id)
-        message = 'Sync successful.'
+        stats = update_role_mapping(team_id)
+        record_sync(team_id)
+        log.info('Sync stats for team %s: %s' % (team_id, stats))
+        try:
+            # A missing set is built on first use, keeping it fresh is left to the schedule.
+            refresh_admins(team_id, context, only_missing=True)
+        except Exception as e:
+            log.exception(e)
+        message = 'Sync successful. %(written)s mappings written, %(removed)s removed, ' \
+                  '%(skipped)s unchanged.' % stats
+    except SlackError as e:
+        log.exception(e)
+        invalidate_token(event['team_id'], e)
+        message = e.message
     except Exception as e:
         log.exception(e)
         message = e.message
+    sessions.report(metrics)
+    metrics.emit()
     return {
         "response_type": "in_channel",
         'text': message
     }
+
+
+def resolve_user_roles(slack, team_config, users):
+    # Same rule as resolve_roles, but only these users' memberships are looked up.
+    configs = sorted(team_config, key=lambda config: config.priority)
+    usergroups = dict((config.id, set(fetch_members(slack, config)['members'] or ()))
+                      for config in configs if config.type == 'usergroup')
+    roles = {}
+    for user in users:
+        conversations = set()
+        if len(usergroups) < len(configs):
+            conversations = set(conversation['id'] for conversation in
+                                paginate(slack, 'users.conversations', 'channels', user=user,
+                                         types='public_channel,private_channel', exclude_archived=True))
+        best = next((config for config in configs
+                     if config.id in conversations or user in usergroups.get(config.id, ())), None)
+        roles[user] = best.arn if best else None
+    return roles
+
+
+def write_user_roles(team_id, roles):
+    # Stored as generation tagged overrides, which Alfred prefers over the role table
+    # until the next sync writes a generation that already includes the change.
+    mc = MemCacheHelper()
+    generation, _ = read_pointer(mc.get(ROLE_TABLE_KEY % team_id))
+    values = dict(('%s_%s' % (team_id, user), '%s|%s' % (generation, role or NO_ROLE))
+                  for user, role in roles.iteritems())
+    with metrics.span('memcached_write'):
+        mc.set_many(values)
+    metrics.count('mappings_written', len(values))
+    log.info('Updated roles of %s users in team %s from an event' % (len(values), team_id))
+
+
+def membership_change(event):
+    """Returns the channel/group/usergroup id and the users affected by a membership event."""
+    if event.get('type') in ('member_joined_channel', 'member_left_channel'):
+        return event['channel'], [event['user']]
+    if event.get('type') == 'subteam_members_changed':
+        return event['subteam_id'], event.get('added_users', []) + event.get('removed_users', [])
+    return None, []
+
+
+def handle_event(team_id, event):
+    config_id, users = membership_change(event)
+    if not users:
+        return
+    with metrics.span('dynamodb_team_config'):
+        team_config = get_team_config(team_id)
+    if config_id not in set(config.id for config in team_config):
+        # Not a mapped channel/group/usergroup, so nobody's role changes.
+        metrics.count('events_ignored')
+        return
+    if len(users) > EVENT_MAX_USERS:
+        log.info('Membership event for %s users of team %s left to the next sync' % (len(users), team_id))
+        metrics.count('events_deferred')
+        MemCacheHelper().set(CONFIG_CHANGED_KEY % team_id, str(time.time()))
+        return
+    slack = Slacker(get_token(team_id), session=sessions.get_session())
+    write_user_roles(team_id, resolve_user_roles(slack, team_config, users))
+
+
+_signing_secret = None
+
+
+def get_signing_secret():
+    # Kept with the app's client id and secret, see outsider.load_credentials.
+    global _signing_secret
+    if _signing_secret is None:
+        body = boto3.resource('s3').Object(CREDENTIALS_BUCKET, CREDENTIALS_OBJECT).get()['Body']
+        _signing_secret = json.loads(body.read())['signing_secret'].encode('utf-8')
+    return _signing_secret
+
+
+def verify_signature(headers, body):
+    timestamp = headers.get('x-slack-request-timestamp', '')
+    if not timestamp.isdigit() or abs(time.time() - int(timestamp)) > SLACK_SIGNATURE_MAX_AGE:
+        return False
+    expected = 'v0=' + hmac.new(get_signing_secret(), 'v0:%s:%s' % (timestamp, body), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, headers.get('x-slack-signature', '').encode('utf-8'))
+
+
+def respond(status, body):
+    return {'statusCode': status, 'headers': {'Content-Type': 'application/json'}, 'body': json.dumps(body)}
+
+
+def events_handler(event, context):
+    """Entry point for the Slack Events API request URL, behind an API Gateway proxy integration.
+
+    Only requests signed with the app's signing secret are handled, as the raw body
+    is needed to check the signature.
+    """
+    metrics.start()
+    payload = {}
+    try:
+        headers = dict((name.lower(), value) for name, value in (event.get('headers') or {}).iteritems())
+        body = event.get('body') or ''
+        body = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode('utf-8')
+        if not verify_signature(headers, body):
+            metrics.count('events_rejected')
+            return respond(401, {'ok': False})
+        payload = json.loads(body)
+        log.debug(payload)
+        if payload.get('type') == 'url_verification':
+            return respond(200, {'challenge': payload['challenge']})
+        metrics.count('events_received')
+        if headers.get('x-slack-retry-reason') == 'http_timeout':
+            # The first delivery got here and is handled, it only answered later than Slack waits.
+            # Other retries mean the first delivery never reached this handler.
+            metrics.count('events_retry_ignored')
+            return respond(200, {'ok': True})
+        handle_event(payload['team_id'], payload['event'])
+    except SlackError as e:
+        log.exception(e)
+        invalidate_token(payload['team_id'], e)
+    except Exception as e:
+        # Acknowledged anyway, a retry would most likely fail the same way and the next sync catches up.
+        log.exception(e)
+    finally:
+        sessions.report(metrics)
+        metrics.emit()
+    return respond(200, {'ok': True})
+
+
+def plan_syncs(now):
+    """Teams due for a sync, those with mapping changes since their last sync first."""
+    team_ids = [team.team_id for team in TeamModel.scan()]
+    keys = [key % team_id for team_id in team_ids for key in (SYNCED_KEY, CONFIG_CHANGED_KEY)]
+    mc = MemCacheHelper()
+    values = {}
+    for start in range(0, len(keys), SET_MANY_BATCH_SIZE):
+        values.update(mc.get_many(keys[start:start + SET_MANY_BATCH_SIZE]))
+    plan = []
+    for team_id in team_ids:
+        synced = float(values.get(SYNCED_KEY % team_id, 0))
+        changed = float(values.get(CONFIG_CHANGED_KEY % team_id, 0)) > synced
+        if changed or now - synced >= SCHEDULE_MIN_AGE:
+            plan.append((not changed, synced, team_id))
+    metrics.count('teams_not_due', len(team_ids) - len(plan))
+    return [(team_id, synced) for _, synced, team_id in sorted(plan)]
+
+
+def sync_team(team_id, synced, start_at, context):
+    time.sleep(max(0, start_at - time.time()))
+    # Checked again after the wait, since syncs ahead of it in the pool may have run long.
+    if context and context.get_remaining_time_in_millis() < SCHEDULE_TIME_RESERVE_MS:
+        # Not synced, so it is among the stalest teams of the next run.
+        metrics.count('teams_deferred')
+        return
+    team_metrics = Metrics('thaddeus', Team=team_id)
+    try:
+        with team_metrics.span('sync'):
+            stats = update_role_mapping(team_id)
+        record_sync(team_id)
+        log.info('Scheduled sync stats for team %s: %s' % (team_id, stats))
+        metrics.count('teams_synced')
+        try:
+            refresh_admins(team_id, context)
+        except Exception as e:
+            # Eagle checks admins live while the set is missing, so this never fails a sync.
+            log.exception(e)
+    except SlackError as e:
+        log.exception(e)
+        invalidate_token(team_id, e)
+        metrics.count('teams_failed')
+        team_metrics.count('sync_failed')
+    except Exception as e:
+        log.exception(e)
+        metrics.count('teams_failed')
+        team_metrics.count('sync_failed')
+    if synced:
+        team_metrics.count('staleness_seconds', round(team_metrics.started - synced, 1))
+    team_metrics.emit()
+
+
+_schedule_pool = None
+
+
+def get_schedule_pool():
+    global _schedule_pool
+    if _schedule_pool is None:
+        _schedule_pool = ThreadPool(SCHEDULE_CONCURRENCY)
+    return _schedule_pool
+
+
+def schedule_handler(event, context):
+    """Entry point for a periodic (e.g. CloudWatch Events) trigger that keeps every team fresh."""
+    metrics.start()
+    try:
+        started = time.time()
+        plan = plan_syncs(started)
+        deadline = float('inf')
+        if context:
+            deadline = started + (context.get_remaining_time_in_millis() - SCHEDULE_TIME_RESERVE_MS) / 1000.0
+        # Slots starting past the deadline are not waited for, they are the stalest teams of the next run.
+        slots = [slot for slot in range(len(plan)) if started + slot * SCHEDULE_SPACING <= deadline]
+        metrics.count('teams_deferred', len(plan) - len(slots))
+        log.info('Scheduled sync of %s of %s due teams' % (len(slots), len(plan)))
+
+        def run(slot):
+            team_id, synced = plan[slot]
+            sync_team(team_id, synced, started + slot * SCHEDULE_SPACING, context)
+
+        get_schedule_pool().map(run, slots, chunksize=1)
+        return {'teams': len(slots), 'deferred': len(plan) - len(slots)}
+    finally:
+        sessions.report(metrics)
+        metrics.emit()